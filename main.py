@@ -1,29 +1,112 @@
 import argparse
 from src.gelos_config import GELOSConfig
-from src.downloader import Downloader
 import shutil
 from pathlib import Path
-from src.data_cleaner import DataCleaner
+import time
+
+# stages import their modules when they run, so light stages do not load dask, stackstac or the STAC client
+STAGES = ['search', 'chip', 'clean', 'publish']
+
+def status(gelosconfig, follow=False, interval=60):
+    """Print progress of a run from its event stream, without touching its metadata files"""
+    from src.status import RunStatus
+    events_path = Path(gelosconfig.directory.working) / gelosconfig.dataset.version / 'events.jsonl'
+    run_status = RunStatus(events_path)
+    while True:
+        run_status.refresh()
+        print(run_status.report())
+        if not follow:
+            return
+        time.sleep(interval)
+        print()
+
+def plan(gelosconfig):
+    """Estimate the chips, bytes and requests of a run, without changing the state a run resumes from"""
+    from src.downloader import Downloader
+    from src.planner import CapacityPlanner
+    CapacityPlanner(Downloader(gelosconfig, dry_run=True)).plan()
+
+def search(gelosconfig):
+    """Search all AOIs and save their scene selections to the working directory"""
+    from src.downloader import Downloader
+    gelosconfig.search.cache = True
+    Downloader(gelosconfig).search()
+
+def chip(gelosconfig, reuse_searches=False):
+    """
+    Stack and chip all AOIs, reusing saved scene selections when reuse_searches is set.
+    Returns False when other queue workers are still running, the last one cleans and publishes.
+    """
+    from src.downloader import Downloader
+    if reuse_searches:
+        gelosconfig.search.cache = True
+    downloader = Downloader(gelosconfig)
+    downloader.download()
+    # with a shared work queue only the last worker to finish merges results and cleans
+    return not gelosconfig.queue.enabled or downloader.finalize_queue()
+
+def clean(gelosconfig):
+    """Select, balance and number the chips of the release"""
+    from src.data_cleaner import DataCleaner
+    DataCleaner(gelosconfig).clean()
+
+def publish(gelosconfig):
+    """Write the chip tracker, copy the selected chips to the release and compute QA statistics"""
+    from src.data_cleaner import DataCleaner
+    DataCleaner(gelosconfig).publish()
+    if gelosconfig.qa.enabled:
+        from src.quality import DatasetQA
+        DatasetQA(gelosconfig).run()
 
 def main():
     parser = argparse.ArgumentParser(description='Run GFM benchmark pipeline')
-    parser.add_argument('--config', '-c', 
+    parser.add_argument('command',
+                       nargs='?',
+                       default='run',
+                       choices=['run', 'status', 'plan'] + STAGES,
+                       help='run the pipeline, show progress of a running pipeline, estimate the '
+                            'chips, bytes and requests of a run without downloading, or run a single '
+                            'stage: search, chip, clean or publish (default: run)')
+    parser.add_argument('--config', '-c',
                        default='config.yml',
                        help='Path to config file (default: config.yml)')
-    
+    parser.add_argument('--force',
+                       action='store_true',
+                       help='process AOIs whose failures are in the negative result cache again')
+    parser.add_argument('--follow', '-f',
+                       action='store_true',
+                       help='with status, keep refreshing the progress report')
+    parser.add_argument('--interval',
+                       type=int,
+                       default=60,
+                       help='with status --follow, seconds between refreshes (default: 60)')
+
     args = parser.parse_args()
     gelosconfig = GELOSConfig.from_yaml(args.config)
+    if args.force:
+        gelosconfig.negative_cache.force = True
+    if args.command == 'status':
+        status(gelosconfig, args.follow, args.interval)
+        return
     working_directory = Path(gelosconfig.directory.working) / gelosconfig.dataset.version
     # create working directory with version number if none exists
     working_directory.mkdir(exist_ok=True)
     # copy yaml to working directory
     shutil.copy(args.config, working_directory / "config.yaml")
-   
-    downloader = Downloader(gelosconfig)
-    downloader.download()
-    
-    cleaner = DataCleaner(gelosconfig)
-    cleaner.clean()
-    
+
+    if args.command == 'plan':
+        plan(gelosconfig)
+    elif args.command == 'search':
+        search(gelosconfig)
+    elif args.command == 'chip':
+        chip(gelosconfig, reuse_searches=True)
+    elif args.command == 'clean':
+        clean(gelosconfig)
+    elif args.command == 'publish':
+        publish(gelosconfig)
+    elif chip(gelosconfig):
+        clean(gelosconfig)
+        publish(gelosconfig)
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,4 +1,7 @@
 import pdb
+import json
+import os
+import uuid
 import xarray as xr
 import rioxarray as rxr
 from src.gelos_config import GELOSConfig
@@ -8,28 +11,182 @@ import pandas as pd
 import geopandas as gpd
 
 from .utils.search import search_s2l2a_scenes, search_s1rtc_scenes, search_lc2l2_scenes, search_annual_scene, count_unique_dates, get_lc2l2_wrs_path
-from .utils.stack import stack_data, stack_dem_data, stack_lulc_data, pystac_itemcollection_to_gdf
+from .utils.stack import stack_data, stack_dem_data, stack_lulc_data, stack_coverage, pystac_itemcollection_to_gdf, build_gdal_env, build_reader, chip_aligned_chunksize
+from .utils.memory import estimate_stack_nbytes
+from .utils.footprints import FootprintIndex
+from .utils.events import read_events
+from shapely.geometry import box
 from functools import reduce
 
+# asset of the elevation values in the DEM items, which also hold non raster assets
+DEM_ASSET = "data"
+
 class AOI_Processor:
     """Responsible for processing one AOI, managed by Downloader"""
-    def __init__(self, aoi_index, aoi, chip_index, working_directory, catalog, config: GELOSConfig):
+    def __init__(self, aoi_index, aoi, chip_index, working_directory, catalog, config: GELOSConfig, chip_index_allocator=None, footprint_index=None, memory_budget=None, events=None, stack_cache=None, negative_cache=None, chip_store=None):
         self.config = config
         self.catalog = catalog
         self.aoi_index = aoi_index
         self.aoi = aoi
         self.chip_index = chip_index
+        # callable reserving a block of chip indices, used when chip indices are shared between workers
+        self.chip_index_allocator = chip_index_allocator
+        # run-wide index of accepted chip footprints, used to skip duplicate chips
+        self.footprint_index = footprint_index
+        # footprints of the chips accepted in this AOI, added to the run-wide index once the AOI
+        # is committed so a retried AOI never finds its own chips as duplicates
+        self.accepted_footprints = None
+        if footprint_index is not None:
+            self.accepted_footprints = FootprintIndex(
+                overlap_threshold=footprint_index.overlap_threshold, cell_size=footprint_index.cell_size
+            )
+        # run-wide MemoryBudget which computed stacks are reserved against
+        self.memory_budget = memory_budget
+        self.memory_estimates = {}
+        # local StackCache of computed stacks, shared by the AOIs of a run
+        self.stack_cache = stack_cache
+        # NegativeResultCache of deterministic AOI failures, shared by dataset versions
+        self.negative_cache = negative_cache
+        # ChipStore of generated chip files, shared by dataset versions
+        self.chip_store = chip_store
+        # EventLog receiving chip progress events
+        self.events = events
         self.working_directory = working_directory
         self.stacks = {}
         self.s2l2a_scene_id = None
         self.lc2l2_wrs_path = None
         self.s1rtc_relative_orbit = None
+        self.gdal_env = build_gdal_env(self.config.io)
+        self.read_error_log = self.working_directory / "read_errors.jsonl"
+        # distinguishes read errors of this attempt from errors of earlier attempts at the AOI
+        self.attempt_id = uuid.uuid4().hex
+        self.searched = False
+        # error raised by a search run ahead of processing, re-raised by process_aoi
+        self.search_error = None
+
+
+    def reader_for(self, platform):
+        """Stack reader whose failed windows are logged with the AOI and platform they belong to"""
+        return build_reader(
+            self.config.io,
+            error_log=self.read_error_log,
+            context={"aoi_index": int(self.aoi_index), "attempt": self.attempt_id, "platform": platform},
+        )
 
+    def read_errors(self):
+        """Bounds of windows of this AOI which could not be read, by platform"""
+        errors, _ = read_events(self.read_error_log)
+        failed = {}
+        for error in errors:
+            if error["attempt"] == self.attempt_id:
+                failed.setdefault(error["platform"], []).append(box(*error["bounds"]))
+        return failed
+
+    def chunksize(self, platform, items, n_bands=1, per_item=False):
+        """
+        Dask chunksize for a platform stack, aligned to the chip sampling grid unless set in config.
+        With per_item, every item is its own chunk along time so tiles can be mosaicked lazily.
+        """
+        platform_config = getattr(self.config, platform)
+        time_chunk = 1 if per_item else -1
+        override = (self.config.io.chunksize or {}).get(platform)
+        if override:
+            return (time_chunk, -1, override, override)
+        return chip_aligned_chunksize(
+            platform_config.resolution,
+            self.config.chips.sample_size,
+            len(items),
+            n_bands,
+            platform_config.dtype,
+            cog_block_size=self.config.io.cog_block_size,
+            chunk_bytes=self.config.io.chunk_bytes,
+            time_chunk=time_chunk,
+        )
+
+    def estimate_memory(self, bounds):
+        """Estimate the size of each computed stack over projected bounds, after masking and compositing"""
+        n_times = len(self.config.s2l2a.time_ranges)
+        n_times_by_platform = {
+            "s2l2a": len(self.itemcollections["s2l2a"]),
+            "lc2l2": n_times,
+            "s1rtc": n_times,
+            "dem": 1,
+            "lulc": 1,
+        }
+        for platform, n_times in n_times_by_platform.items():
+            platform_config = getattr(self.config, platform)
+            n_bands = len(getattr(platform_config, "bands", None) or [None])
+            if getattr(platform_config, "cloud_band", None):
+                n_bands -= 1
+            self.memory_estimates[platform] = estimate_stack_nbytes(
+                bounds, platform_config.resolution, n_bands, n_times, platform_config.dtype
+            )
+        total = sum(self.memory_estimates.values())
+        print(f"estimated stack memory {total / 1e9:.2f} GB")
+        return total
 
     def process_aoi(self):
         """Process one AOI by searching and stacking data sources"""
         print(f"\nProcessing AOI at index {self.aoi_index}")
+        if self.search_error is not None:
+            raise self.search_error
+        if not self.searched:
+            self.search()
+        self.stack()
+
+        chip_generator = ChipGenerator(self)
+        chip_gdf = chip_generator.generate_from_aoi()
+        return chip_gdf
+
+    @property
+    def search_cache_path(self):
+        return self.working_directory / f"{self.aoi_index}_search.json"
+
+    def search(self):
+        """Select scenes for the AOI, reusing a cached search result when search caching is enabled"""
+        if self.negative_cache is not None:
+            reason = self.negative_cache.lookup(self.aoi.geometry)
+            if reason:
+                print(f"skipping AOI {self.aoi_index}, cached failure: {reason}")
+                raise ValueError(reason)
+        if self.config.search.cache and self.search_cache_path.exists():
+            self.load_search()
+            return
+        self.search_catalog()
+        if self.config.search.cache:
+            self.save_search()
+
+    def save_search(self):
+        """Write the scene selection of the AOI, so later runs and plans can skip the search"""
+        search = {
+            "epsg": self.epsg,
+            "s2l2a_bbox": self.s2l2a_bbox,
+            "overlap_bounds": self.overlap_bounds,
+            "itemcollections": {platform: items.to_dict() for platform, items in self.itemcollections.items()},
+        }
+        tmp_path = self.search_cache_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(search, f)
+        os.replace(tmp_path, self.search_cache_path)
 
+    def load_search(self):
+        """Restore the scene selection of the AOI from the search cache"""
+        print(f"using cached search for AOI {self.aoi_index}")
+        with open(self.search_cache_path) as f:
+            search = json.load(f)
+        self.epsg = search["epsg"]
+        self.s2l2a_bbox = search["s2l2a_bbox"]
+        self.overlap_bounds = tuple(search["overlap_bounds"])
+        self.itemcollections = {
+            platform: pystac.ItemCollection.from_dict(items) for platform, items in search["itemcollections"].items()
+        }
+        self.scene_ids = {
+            f"{platform}_scene_ids": ','.join([item.id for item in items]) for platform, items in self.itemcollections.items()
+        }
+        self.searched = True
+
+    def search_catalog(self):
+        """Select the scenes of every data source for the AOI and the bounds of their overlap"""
         s2l2a_items = pystac.item_collection.ItemCollection([])
         for date_range in self.config.s2l2a.time_ranges:
             print(f"Searching Sentinel-2 scenes for {date_range}")
@@ -141,7 +298,16 @@ class AOI_Processor:
         self.scene_ids = {
             f"{platform}_scene_ids": ','.join([item.id for item in items]) for platform, items in self.itemcollections.items()
         }
-        
+        self.searched = True
+
+    def stack(self):
+        """Build lazy stacks of every data source over the overlap of the selected scenes"""
+        s2l2a_items = self.itemcollections["s2l2a"]
+        s1rtc_items = self.itemcollections["s1rtc"]
+        lc2l2_items = self.itemcollections["lc2l2"]
+        lulc_items = self.itemcollections["lulc"]
+        dem_items = self.itemcollections["dem"]
+
         print("stacking lc2l2 data...")
         self.stacks['lc2l2'] = stack_data(
             lc2l2_items,
@@ -152,10 +318,16 @@ class AOI_Processor:
             self.config.lc2l2.cloud_band,
             self.epsg,
             self.overlap_bounds,
-            bbox_is_latlon = True
+            bbox_is_latlon = True,
+            gdal_env = self.gdal_env,
+            reader = self.reader_for("lc2l2"),
+            chunksize = self.chunksize("lc2l2", lc2l2_items, len(self.config.lc2l2.bands)),
+            dtype = self.config.lc2l2.dtype,
+            fill_value = self.config.lc2l2.na_value,
         )
         
         overlap_bbox = self.stacks['lc2l2'].rio.bounds()
+        self.estimate_memory(overlap_bbox)
 
         print("stacking dem data...")
         self.stacks['dem'] = stack_dem_data(
@@ -164,7 +336,13 @@ class AOI_Processor:
             self.config.dem.resolution, 
             self.epsg, 
             overlap_bbox,
-            bbox_is_latlon=False
+            bbox_is_latlon=False,
+            gdal_env=self.gdal_env,
+            reader=self.reader_for("dem"),
+            chunksize=self.chunksize("dem", dem_items, per_item=self.config.dem.composite == "mosaic"),
+            dtype=self.config.dem.dtype,
+            fill_value=self.config.dem.na_value,
+            composite=self.config.dem.composite,
         )
 
         print("stacking land cover data...")
@@ -174,7 +352,13 @@ class AOI_Processor:
             self.config.lulc.resolution, 
             self.epsg, 
             overlap_bbox,
-            bbox_is_latlon=False
+            bbox_is_latlon=False,
+            gdal_env=self.gdal_env,
+            reader=self.reader_for("lulc"),
+            chunksize=self.chunksize("lulc", lulc_items, per_item=self.config.lulc.composite == "mosaic"),
+            dtype=self.config.lulc.dtype,
+            fill_value=self.config.lulc.na_value,
+            composite=self.config.lulc.composite,
         )
 
 
@@ -188,7 +372,12 @@ class AOI_Processor:
             None,  # No cloud band for Sentinel-1
             self.epsg,
             overlap_bbox,
-            bbox_is_latlon=False
+            bbox_is_latlon=False,
+            gdal_env=self.gdal_env,
+            reader=self.reader_for("s1rtc"),
+            chunksize=self.chunksize("s1rtc", s1rtc_items, len(self.config.s1rtc.bands)),
+            dtype=self.config.s1rtc.dtype,
+            fill_value=self.config.s1rtc.na_value,
         )
 
         print("stacking s2l2a data...")
@@ -201,12 +390,68 @@ class AOI_Processor:
             self.config.s2l2a.cloud_band,
             self.epsg,
             overlap_bbox,
-            bbox_is_latlon=False
+            bbox_is_latlon=False,
+            gdal_env=self.gdal_env,
+            reader=self.reader_for("s2l2a"),
+            chunksize=self.chunksize("s2l2a", s2l2a_items, len(self.config.s2l2a.bands)),
+            dtype=self.config.s2l2a.dtype,
+            fill_value=self.config.s2l2a.na_value,
         )
 
-        chip_generator = ChipGenerator(self)
-        chip_gdf = chip_generator.generate_from_aoi()
-        return chip_gdf
-        
+    def coverage_stacks(self):
+        """
+        Lazy low resolution masks of the pixels where each sensor stack is expected to hold a valid
+        value for every date, over the land cover stack. Sensors which fill nodata are not checked.
+        """
+        bounds = self.stacks['lulc'].rio.bounds()
+        # reads which fail raise instead of being logged, so they never mark chips as read errors
+        reader = build_reader(self.config.io)
+        time_reductions = {"s2l2a": "all", "lc2l2": "quarter", "s1rtc": "quarter", "dem": "any"}
+        coverages = {}
+        for name, time_reduction in time_reductions.items():
+            platform_config = getattr(self.config, name)
+            if platform_config.fill_na:
+                continue
+            bands = getattr(platform_config, "bands", None)
+            coverages[name] = stack_coverage(
+                self.itemcollections[name],
+                name,
+                self.epsg,
+                bounds,
+                self.config.chips.precheck_resolution,
+                asset=bands[0] if bands else DEM_ASSET,
+                cloud_band=getattr(platform_config, "cloud_band", None),
+                time_reduction=time_reduction,
+                gdal_env=self.gdal_env,
+                reader=reader,
+            )
+        return coverages
+
+    def stack_cache_key(self, name):
+        platform_config = getattr(self.config, name)
+        return self.stack_cache.key(
+            name,
+            [item.id for item in self.itemcollections[name]],
+            epsg=self.epsg,
+            bounds=self.overlap_bounds,
+            resolution=platform_config.resolution,
+            bands=getattr(platform_config, "bands", None),
+            cloud_band=getattr(platform_config, "cloud_band", None),
+            time_ranges=self.config.s2l2a.time_ranges,
+            dtype=platform_config.dtype,
+            na_value=platform_config.na_value,
+            composite=getattr(platform_config, "composite", None),
+        )
 
+    def cached_window(self, name, window, start):
+        """The window of a stack starting at pixel row start from the stack cache, or None"""
+        if self.stack_cache is None:
+            return None
+        return self.stack_cache.window(self.stack_cache_key(name), name, start, start + window.sizes['y'])
 
+    def cache_window(self, name, start, computed):
+        """Write a computed window of a stack to the stack cache"""
+        # stacks with windows which could not be read are not cached
+        if self.stack_cache is None or name in self.read_errors():
+            return
+        self.stack_cache.write(self.stack_cache_key(name), self.stacks[name], start, computed)
@@ -3,40 +3,191 @@ if TYPE_CHECKING:
     from src.aoi_processor import AOI_Processor
 from src.utils.output import save_multitemporal_chips, save_thumbnails
 from src.utils.array import process_array
+from src.utils.chip_store import ChipStore
+from contextlib import nullcontext
+from shapely.geometry import box
+import dask
 import numpy as np
 import pandas as pd
+import os
+import time
+from pathlib import Path
+
+# platform settings which change the values of chip files
+STACK_PARAMS = ["resolution", "native_crs", "bands", "cloud_band", "dtype", "na_value", "fill_na", "composite"]
 
 class ChipGenerator:
     def __init__(self, processor: "AOI_Processor"):
         self.processor = processor
         self.chip_entries = []
+        self.read_errors = {}
         
+    def remove_stale_files(self, index):
+        """
+        Remove files left at a chip index by an interrupted attempt. They may be hard links into the
+        chip store, so they are never overwritten in place.
+        """
+        if os.path.exists(f"{self.processor.working_directory}/lc_{index:06}.tif"):
+            for path in Path(self.processor.working_directory).glob(f"*_{index:06}[._]*"):
+                path.unlink()
+
+    def save_array(self, index, name, array):
+        """Saves the chip files of one data source, returning the saved dates of multitemporal sources"""
+        directory = self.processor.working_directory
+        if name in ['lulc', 'dem']:
+            prefix = 'lc' if name == 'lulc' else 'dem'
+            array.rio.to_raster(f"{directory}/{prefix}_{index:06}.tif")
+            return None
+        dates = save_multitemporal_chips(array, directory, index)
+        save_thumbnails(array, directory, index)
+        return dates
+
     def gen_chips(self, index, arrays):
         """
         Saves chip data arrays to files.
         """
-        lulc_path = f"{self.processor.working_directory}/lc_{index:06}.tif"
-        dem_path = f"{self.processor.working_directory}/dem_{index:06}.tif"
-        s2l2a_dates, s1rtc_dates, lc2l2_dates = [], [], []
-        s2l2a_dates = save_multitemporal_chips(arrays['s2l2a'], self.processor.working_directory, index)
-        s1rtc_dates = save_multitemporal_chips(arrays['s1rtc'], self.processor.working_directory, index)
-        lc2l2_dates = save_multitemporal_chips(arrays['lc2l2'], self.processor.working_directory, index)
-
-        save_thumbnails(arrays['s2l2a'], self.processor.working_directory, index)
-        save_thumbnails(arrays['lc2l2'], self.processor.working_directory, index)
-        save_thumbnails(arrays['s1rtc'], self.processor.working_directory, index)
-    
-        arrays['lulc'].rio.to_raster(lulc_path)
-        arrays['dem'].rio.to_raster(dem_path)
-        return s2l2a_dates, s1rtc_dates, lc2l2_dates
+        self.remove_stale_files(index)
+        dates = {name: self.save_array(index, name, arrays[name]) for name in ['s2l2a', 's1rtc', 'lc2l2', 'lulc', 'dem']}
+        return dates['s2l2a'], dates['s1rtc'], dates['lc2l2']
  
+    def chip_files(self, index, dates):
+        """Paths of the files written for a chip, from the dates saved per platform"""
+        directory = self.processor.working_directory
+        paths = [f"{directory}/lc_{index:06}.tif", f"{directory}/dem_{index:06}.tif"]
+        for name, platform_dates in dates.items():
+            for i, date in enumerate(platform_dates.split(',')):
+                paths += [f"{directory}/{name}_{index:06}_{i}_{date}.{ext}" for ext in ("tif", "png")]
+        return [path for path in paths if os.path.exists(path)]
+
+    def chip_nbytes(self, index, dates):
+        """Total size of the files written for a chip, from the dates saved per platform"""
+        return sum(os.path.getsize(path) for path in self.chip_files(index, dates))
+
+    def chip_key(self, x, y):
+        """
+        Chip store key of the chip at sample block (x, y): its scenes, pixel window and the stacking
+        and output parameters of every platform, but none of the sampling or cleaning settings
+        """
+        config = self.processor.config
+        lulc = self.processor.stacks['lulc']
+        sample_pixels = int(config.chips.sample_size / config.lulc.resolution)
+        margin = int((int(config.chips.chip_size / config.lulc.resolution) - sample_pixels) / 2)
+        return ChipStore.key(
+            scene_ids=self.processor.scene_ids,
+            epsg=self.processor.epsg,
+            origin=(float(lulc.x[0]), float(lulc.y[0])),
+            window=(int(x) * sample_pixels - margin, int(y) * sample_pixels - margin),
+            chip_size=config.chips.chip_size,
+            sample_size=config.chips.sample_size,
+            platforms={
+                name: {param: getattr(getattr(config, name), param, None) for param in STACK_PARAMS}
+                for name in ['s2l2a', 's1rtc', 'lc2l2', 'dem', 'lulc']
+            },
+        )
+
+    def is_stored(self, x, y):
+        chip_store = self.processor.chip_store
+        return chip_store is not None and chip_store.contains(self.chip_key(x, y))
+
+    def emit(self, event, **fields):
+        if self.processor.events is not None:
+            self.processor.events.emit(event, **fields)
+
+    def compute_stack(self, name, stack):
+        """Compute a lazy stack, printing its graph size and load throughput"""
+        print(f"loading {name} stack ({len(stack.__dask_graph__())} tasks)")
+        start = time.perf_counter()
+        computed = stack.compute()
+        elapsed = time.perf_counter() - start
+        print(f"loaded {name} stack in {elapsed:.1f}s ({stack.nbytes / 1e6 / elapsed:.1f} MB/s)")
+        return computed
+
+    def compute_stacks(self, stacks):
+        """
+        Compute lazy stacks in a single dask compute, so the reads of all sensors overlap on the
+        cluster, printing the graph size and load throughput
+        """
+        n_tasks = sum(len(stack.__dask_graph__()) for stack in stacks.values())
+        print(f"loading {', '.join(stacks)} stacks ({n_tasks} tasks)")
+        start = time.perf_counter()
+        (computed,) = dask.compute(stacks)
+        elapsed = time.perf_counter() - start
+        nbytes = sum(stack.nbytes for stack in stacks.values())
+        print(f"loaded {len(stacks)} stacks in {elapsed:.1f}s ({nbytes / 1e6 / elapsed:.1f} MB/s)")
+        return computed
+
+    def load_windows(self, windows, offsets):
+        """
+        Compute stack windows starting at pixel rows offsets in one dask compute, reading windows
+        which are in the stack cache from it and writing the others to it once computed
+        """
+        cached = {name: self.processor.cached_window(name, window, offsets[name]) for name, window in windows.items()}
+        computed = self.compute_stacks({
+            name: window if cached[name] is None else cached[name] for name, window in windows.items()
+        })
+        for name in windows:
+            if cached[name] is None:
+                self.processor.cache_window(name, offsets[name], computed[name])
+        return computed
+
+    def reserve(self, nbytes):
+        """Reserve memory for a computation under the memory budget, if one is configured"""
+        if self.processor.memory_budget is None:
+            return nullcontext()
+        return self.processor.memory_budget.reserve(nbytes)
+
+    def plan_tiles(self, n_block_rows, available_bytes):
+        """
+        Split the sample block rows of the AOI into strips whose computed sensor stacks fit in
+        available_bytes. Returns a list of (first row, end row) and the estimated bytes per strip.
+        """
+        sensor_estimates = [nbytes for name, nbytes in self.processor.memory_estimates.items() if name != 'lulc']
+        # one sensor stack is held at a time when chips are generated sensor at a time
+        sensor_bytes = max(sensor_estimates, default=0) if self.processor.config.chips.sensor_at_a_time else sum(sensor_estimates)
+        if available_bytes is None or sensor_bytes <= available_bytes:
+            return [(0, n_block_rows)], sensor_bytes
+        if not self.processor.config.memory.split:
+            raise ValueError("memory budget exceeded")
+
+        # one extra row per strip accounts for chip margins above and below the strip
+        bytes_per_row = sensor_bytes / max(n_block_rows, 1)
+        rows_per_tile = int(available_bytes // bytes_per_row) - 1
+        if rows_per_tile < 1:
+            raise ValueError("memory budget exceeded")
+        tiles = [(row, min(row + rows_per_tile, n_block_rows)) for row in range(0, n_block_rows, rows_per_tile)]
+        print(f"splitting AOI into {len(tiles)} strips of {rows_per_tile} sample rows to fit the memory budget")
+        return tiles, int(bytes_per_row * (rows_per_tile + 1))
+
+    def tile_window(self, name, stack, first_row, end_row):
+        """Slice the pixel rows of a stack needed for chips in sample rows [first_row, end_row)"""
+        resolution = getattr(self.processor.config, name).resolution
+        sample_pixels = int(self.processor.config.chips.sample_size / resolution)
+        chip_pixels = int(self.processor.config.chips.chip_size / resolution)
+        margin = int((chip_pixels - sample_pixels) / 2)
+        start = max(0, first_row * sample_pixels - margin)
+        end = min(stack.sizes['y'], end_row * sample_pixels + margin)
+        return stack.isel(y=slice(start, end)), start
+
     def generate_from_aoi(self):
-        for name, stack in self.processor.stacks.items():
-            print(f"loading {name} stack")
-            self.processor.stacks[name] = stack.compute()
+        lulc_sample_size = int(self.processor.config.chips.sample_size / self.processor.config.lulc.resolution)
+        n_block_rows = self.processor.stacks['lulc'].sizes['y'] // lulc_sample_size
+
+        # the land cover stack and one strip of sensor stacks are held at once, reserve both up front
+        # so concurrent AOIs never wait on each other while holding part of a reservation
+        lulc_bytes = self.processor.memory_estimates.get('lulc', 0)
+        budget = self.processor.memory_budget
+        available_bytes = budget.budget_bytes - lulc_bytes if budget is not None else None
+        tiles, tile_bytes = self.plan_tiles(n_block_rows, available_bytes)
+
+        with self.reserve(lulc_bytes + tile_bytes):
+            self.processor.stacks['lulc'] = self.load_windows({'lulc': self.processor.stacks['lulc']}, {'lulc': 0})['lulc']
+            self.read_errors = self.processor.read_errors()
+            chip_df = self.generate_from_lulc(tiles)
+        return chip_df
 
+    def candidate_windows(self):
+        """Sample blocks of the computed land cover stack which hold a single valid class, as (ys, xs)"""
         lulc_sample_size = int(self.processor.config.chips.sample_size / self.processor.config.lulc.resolution)
-        
         self.lulc_min = self.processor.stacks['lulc'].coarsen(x = lulc_sample_size,
                                          y = lulc_sample_size,
                                          boundary = "trim"
@@ -50,91 +201,292 @@ class ChipGenerator:
         # self.lulc_uniqueness[-2:, :] = False
         # self.lulc_uniqueness[:, 0:2] = False
         # self.lulc_uniqueness[:, -2:] = False
+        return np.where(self.lulc_uniqueness)
+
+    def precheck(self, ys, xs):
+        """
+        Reasons why candidates at sample blocks (ys, xs) are expected to fail the missing values
+        check, by candidate position, from the low resolution coverage of every sensor. A block
+        fails when any coverage pixel centered in it is invalid.
+        """
+        coverages = self.processor.coverage_stacks()
+        start = time.perf_counter()
+        try:
+            (coverages,) = dask.compute(coverages)
+        except Exception as e:
+            print(f"precheck failed, checking all candidates at full resolution: {e}")
+            return {}
 
-        ys, xs = np.where(self.lulc_uniqueness)
+        # stackstac coordinates are the top left corners of pixels
+        lulc = self.processor.stacks['lulc']
+        left, top = float(lulc.x[0]), float(lulc.y[0])
+        half_pixel = self.processor.config.chips.precheck_resolution / 2
+        sample_size = self.processor.config.chips.sample_size
+        n_rows, n_cols = self.lulc_uniqueness.shape
+        failures = {}
+        for name, valid in coverages.items():
+            rows = np.floor((top - (valid.y.values - half_pixel)) / sample_size).astype(int)
+            cols = np.floor((valid.x.values + half_pixel - left) / sample_size).astype(int)
+            rows, cols = np.meshgrid(rows, cols, indexing='ij')
+            inside = (rows >= 0) & (rows < n_rows) & (cols >= 0) & (cols < n_cols)
+            blocks = np.ones((n_rows, n_cols), dtype=bool)
+            np.logical_and.at(blocks, (rows[inside], cols[inside]), valid.values[inside])
+            for index in np.flatnonzero(~blocks[ys, xs]):
+                failures.setdefault(index, f"{name} precheck missing values")
+        print(f"precheck rejected {len(failures)} of {len(ys)} candidates in {time.perf_counter() - start:.1f}s")
+        return failures
+
+    def generate_from_lulc(self, tiles):
+        ys, xs = self.candidate_windows()
+        if len(ys) == 0:
+            # land cover windows which could not be read are nodata, so the missing candidates are
+            # only a deterministic failure after a clean land cover read
+            if self.read_errors.get('lulc'):
+                raise ValueError("lulc read error")
+            raise ValueError("no candidate windows")
+        if self.processor.chip_index_allocator:
+            self.processor.chip_index = self.processor.chip_index_allocator(len(ys))
+        failures = self.precheck(ys, xs) if self.processor.config.chips.precheck and len(ys) else {}
 
         # Following indices are added to limit the number of rangeland, bareground, and water chips per tile
         lulc_indices = {1: 0, 2: 0, 5: 0, 7: 0, 8: 0, 11: 0}
 
-        for index in range(0, len(ys)):
+        for first_row, end_row in tiles:
+            tile_candidates = np.flatnonzero((ys >= first_row) & (ys < end_row))
+            if len(tile_candidates) == 0:
+                continue
+            if self.processor.config.chips.sensor_at_a_time:
+                candidates = [(index, xs[index], ys[index]) for index in tile_candidates]
+                self.generate_by_sensor(candidates, first_row, end_row, lulc_indices, failures)
+                continue
+            # compute the sensor stacks for the rows of this strip, keeping the row offset of each,
+            # strips where every candidate failed the precheck or is in the chip store are not read
+            read = any(
+                index not in failures and not self.is_stored(xs[index], ys[index]) for index in tile_candidates
+            )
+            windows, offsets = {}, {}
+            for name, stack in self.processor.stacks.items():
+                if name == 'lulc' or not read:
+                    continue
+                windows[name], offsets[name] = self.tile_window(name, stack, first_row, end_row)
+            stacks = self.load_windows(windows, offsets) if windows else {}
+            # windows which could not be read are nodata, chips overlapping them are rejected
+            self.read_errors = self.processor.read_errors()
+            for index in tile_candidates:
+                self.generate_chip(xs[index], ys[index], stacks, offsets, lulc_indices, failures.get(index))
+            del stacks
 
-            s2l2a_dates, s1rtc_dates, lc2l2_dates = [], [], []
-            footprints = {}
-            arrays = {}
-            status = None
+        chip_df = pd.DataFrame(self.chip_entries)
+        return chip_df
 
-            try:
-                x = xs[index]
-                y = ys[index]
-
-
-                # process the land cover stack first, to check land cover information
-                arrays["lulc"], footprints["lulc"] = process_array(
-                    stack = self.processor.stacks['lulc'],
-                    epsg = self.processor.epsg,
-                    coords = (x, y),
-                    array_name = "lulc",
-                    chip_size = self.processor.config.chips.chip_size,
-                    sample_size = self.processor.config.chips.sample_size,
-                    resolution = self.processor.config.lulc.resolution,
-                    fill_na = self.processor.config.lulc.fill_na,
-                    na_value = self.processor.config.lulc.na_value,
-                    dtype = self.processor.config.lulc.dtype,
-                )
-
-                if (~np.isin(arrays['lulc'], [1, 2, 4, 5, 7, 8, 11])).any():
-                    raise ValueError("lulc_values_wrong")
-
-                if (np.isin(arrays['lulc'], [4])).any():
-                    raise ValueError("lulc_values_flooded_vegetation")
-
-                chip_lulc = int(np.unique(arrays['lulc'])[0])
-                
-                if lulc_indices[chip_lulc] > 400:
-                    raise ValueError(f"lulc_{chip_lulc}_limit")
+    def check_lulc(self, x, y, arrays, footprints):
+        """
+        Extract the land cover chip at sample block (x, y) into arrays and check its values and the
+        land cover read errors. Returns the class of the chip.
+        """
+        arrays["lulc"], footprints["lulc"] = process_array(
+            stack = self.processor.stacks['lulc'],
+            epsg = self.processor.epsg,
+            coords = (x, y),
+            array_name = "lulc",
+            chip_size = self.processor.config.chips.chip_size,
+            sample_size = self.processor.config.chips.sample_size,
+            resolution = self.processor.config.lulc.resolution,
+            fill_na = self.processor.config.lulc.fill_na,
+            na_value = self.processor.config.lulc.na_value,
+            dtype = self.processor.config.lulc.dtype,
+        )
+
+        self.check_read_errors(arrays['lulc'], self.read_errors)
+
+        if (~np.isin(arrays['lulc'], [1, 2, 4, 5, 7, 8, 11])).any():
+            raise ValueError("lulc_values_wrong")
+
+        if (np.isin(arrays['lulc'], [4])).any():
+            raise ValueError("lulc_values_flooded_vegetation")
+
+        return int(np.unique(arrays['lulc'])[0])
+
+    def check_read_errors(self, lulc_array, read_errors):
+        """Raise if the chip overlaps a window of any platform in read_errors which could not be read"""
+        chip_bounds = box(*lulc_array.rio.bounds())
+        for name, failed_windows in read_errors.items():
+            if any(window.intersection(chip_bounds).area > 0 for window in failed_windows):
+                raise ValueError(f"{name} read error")
+
+    def check_accepted(self, chip_lulc, footprint, lulc_indices):
+        """Raise if the chip duplicates an accepted chip or its class reached the AOI limit"""
+        footprint_index = self.processor.footprint_index
+        if footprint_index is not None and (
+            footprint_index.is_duplicate(footprint) or self.processor.accepted_footprints.is_duplicate(footprint)
+        ):
+            raise ValueError("duplicate")
+
+        if lulc_indices[chip_lulc] > 400:
+            raise ValueError(f"lulc_{chip_lulc}_limit")
+
+    def extract(self, name, stack, offset, x, y):
+        """Extract the chip of a sensor stack at sample block (x, y), raising if values are missing"""
+        stack_config = getattr(self.processor.config, name)
+        return process_array(
+            stack = stack,
+            epsg = self.processor.epsg,
+            coords = (x, y),
+            array_name = name,
+            chip_size = self.processor.config.chips.chip_size,
+            sample_size = self.processor.config.chips.sample_size,
+            resolution = stack_config.resolution,
+            fill_na = stack_config.fill_na,
+            na_value = stack_config.na_value,
+            dtype = stack_config.dtype,
+            offset = (0, offset),
+        )
+
+    def accept(self, index, chip_lulc, footprint, dates, lulc_indices):
+        """Count a written chip against its class limit and record it as accepted"""
+        lulc_indices[chip_lulc] += 1
+        if self.processor.accepted_footprints is not None:
+            self.processor.accepted_footprints.add(index, footprint)
+        self.emit(
+            "chip_written",
+            chip_index=index,
+            aoi_index=self.processor.aoi_index,
+            lulc=chip_lulc,
+            bytes=self.chip_nbytes(index, dates),
+        )
+
+    def add_entry(self, index, chip_lulc, footprint, status, dates):
+        if status != 'success':
+            self.emit("chip_failed", chip_index=index, aoi_index=self.processor.aoi_index, reason=status)
+        self.chip_entries.append({
+                'chip_index': index,
+                'aoi_index': self.processor.aoi_index,
+                's2l2a_dates': dates.get('s2l2a', []),
+                's1rtc_dates': dates.get('s1rtc', []),
+                'lc2l2_dates': dates.get('lc2l2', []),
+                'lulc': chip_lulc,
+                'chip_footprint': footprint,
+                'epsg': self.processor.epsg,
+                'status': status,
+                **self.processor.scene_ids
+        })
+
+    def generate_chip(self, x, y, stacks, offsets, lulc_indices, precheck_failure=None):
+        """
+        Check and write the chip at sample block (x, y), recording its metadata entry. Chips with a
+        precheck_failure are rejected with it once their land cover is checked.
+        """
+        index = self.processor.chip_index
+        dates = {}
+        footprints = {}
+        arrays = {}
+        status = None
+        chip_lulc = None
+
+        try:
+            # process the land cover stack first, to check land cover information
+            chip_lulc = self.check_lulc(x, y, arrays, footprints)
+            self.check_accepted(chip_lulc, footprints['lulc'], lulc_indices)
+
+            if precheck_failure:
+                raise ValueError(precheck_failure)
 
+            chip_store = self.processor.chip_store
+            chip_key = self.chip_key(x, y) if chip_store is not None else None
+            if chip_key is not None and chip_store.contains(chip_key):
+                # an identical chip was generated before, by this or an earlier dataset version
+                print(f"Reusing stored chip for chip {index}...")
+                dates = chip_store.get(chip_key, index, self.processor.working_directory)
+            else:
                 # process th rest of the stacks into arrays
-                for name, stack in self.processor.stacks.items():
-                    if name == 'lulc':
-                        continue
-                    stack_config = getattr(self.processor.config, name)
-                    arrays[name], footprints[name] = process_array(
-                        stack = stack,
-                        epsg = self.processor.epsg,
-                        coords = (x, y),
-                        array_name = name,
-                        chip_size = self.processor.config.chips.chip_size,
-                        sample_size = self.processor.config.chips.sample_size,
-                        resolution = stack_config.resolution,
-                        fill_na = stack_config.fill_na,
-                        na_value = stack_config.na_value,
-                        dtype = stack_config.dtype,
-                    )
+                for name, stack in stacks.items():
+                    arrays[name], footprints[name] = self.extract(name, stack, offsets[name], x, y)
 
                 # generate chips from arrays
-                print(f"Generating Chips for chip {self.processor.chip_index}...")
-                s2l2a_dates, s1rtc_dates, lc2l2_dates = self.gen_chips(self.processor.chip_index, arrays)
-                status = 'success'
-                lulc_indices[chip_lulc] += 1
+                print(f"Generating Chips for chip {index}...")
+                s2l2a_dates, s1rtc_dates, lc2l2_dates = self.gen_chips(index, arrays)
+                dates = {'s2l2a': s2l2a_dates, 's1rtc': s1rtc_dates, 'lc2l2': lc2l2_dates}
+                if chip_key is not None:
+                    chip_store.put(chip_key, index, self.chip_files(index, dates), dates)
+            status = 'success'
+            self.accept(index, chip_lulc, footprints['lulc'], dates, lulc_indices)
+
+        except Exception as e:
+            print(e)
+            status = str(e)    
 
+        finally:
+            self.add_entry(index, chip_lulc, footprints.get('lulc'), status, dates)
+            self.processor.chip_index += 1
+
+    def generate_by_sensor(self, candidates, first_row, end_row, lulc_indices, failures):
+        """
+        Generate the chips of the candidates of one strip one sensor at a time: fix the candidates
+        which pass the land cover checks, then compute each sensor stack, write its files for every
+        remaining candidate and release it before the next one. Statuses are merged at the end, where
+        class limits are applied in candidate order and files of rejected chips are removed.
+        """
+        chips = []
+        for position, (candidate, x, y) in enumerate(candidates):
+            chip = {"x": x, "y": y, "index": self.processor.chip_index + position, "arrays": {}, "footprints": {},
+                    "dates": {}, "lulc": None, "status": None, "key": None}
+            chips.append(chip)
+            try:
+                chip["lulc"] = self.check_lulc(x, y, chip["arrays"], chip["footprints"])
+                # class limits are applied when statuses are merged
+                self.check_accepted(chip["lulc"], chip["footprints"]["lulc"], {c: 0 for c in lulc_indices})
+                if candidate in failures:
+                    raise ValueError(failures[candidate])
+                self.remove_stale_files(chip["index"])
+                chip_store = self.processor.chip_store
+                chip["key"] = self.chip_key(x, y) if chip_store is not None else None
+                if chip["key"] is not None and chip_store.contains(chip["key"]):
+                    print(f"Reusing stored chip for chip {chip['index']}...")
+                    chip["dates"] = chip_store.get(chip["key"], chip["index"], self.processor.working_directory)
+                    chip["status"] = "stored"
             except Exception as e:
                 print(e)
-                status = str(e)    
-
-            finally:
-                self.chip_entries.append({
-                        'chip_index': self.processor.chip_index,
-                        'aoi_index': self.processor.aoi_index,
-                        's2l2a_dates': s2l2a_dates,
-                        's1rtc_dates': s1rtc_dates,
-                        'lc2l2_dates': lc2l2_dates,
-                        'lulc': chip_lulc,
-                        'chip_footprint': footprints.get('lulc'),
-                        'epsg': self.processor.epsg,
-                        'status': status,
-                        **self.processor.scene_ids
-                })
-                self.processor.chip_index += 1
+                chip["status"] = str(e)
 
-        chip_df = pd.DataFrame(self.chip_entries)
-        return chip_df 
\ No newline at end of file
+        for name, stack in self.processor.stacks.items():
+            pending = [chip for chip in chips if chip["status"] is None]
+            if name == 'lulc' or not pending:
+                continue
+            window, offset = self.tile_window(name, stack, first_row, end_row)
+            computed = self.load_windows({name: window}, {name: offset})[name]
+            failed_windows = self.processor.read_errors().get(name)
+            read_errors = {name: failed_windows} if failed_windows else {}
+            for chip in pending:
+                try:
+                    self.check_read_errors(chip["arrays"]["lulc"], read_errors)
+                    array, _ = self.extract(name, computed, offset, chip["x"], chip["y"])
+                    chip["dates"][name] = self.save_array(chip["index"], name, array)
+                except Exception as e:
+                    print(e)
+                    chip["status"] = str(e)
+            # release the computed stack before the next sensor is read
+            del computed
+
+        for chip in chips:
+            index, status, dates = chip["index"], chip["status"], chip["dates"]
+            sensor_dates = {name: value for name, value in dates.items() if value is not None}
+            try:
+                if status not in [None, "stored"]:
+                    raise ValueError(status)
+                self.check_accepted(chip["lulc"], chip["footprints"]["lulc"], lulc_indices)
+                if status is None:
+                    print(f"Generating Chips for chip {index}...")
+                    self.save_array(index, 'lulc', chip["arrays"]["lulc"])
+                    if chip["key"] is not None:
+                        self.processor.chip_store.put(chip["key"], index, self.chip_files(index, sensor_dates), sensor_dates)
+                self.accept(index, chip["lulc"], chip["footprints"]["lulc"], sensor_dates, lulc_indices)
+                status = 'success'
+            except Exception as e:
+                if chip["status"] in [None, "stored"]:
+                    print(e)
+                status = str(e)
+                # files written for sensors before the chip failed
+                for path in self.chip_files(index, sensor_dates):
+                    os.remove(path)
+            self.add_entry(index, chip["lulc"], chip["footprints"].get("lulc"), status, sensor_dates if status == 'success' else {})
+        self.processor.chip_index += len(chips)
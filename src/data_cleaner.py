@@ -1,16 +1,17 @@
 import numpy as np
 import pandas as pd
 import ast 
+import json
+import os
 import geopandas as gpd
 from shapely.geometry import Point
 import shutil
 from tqdm import tqdm
 from pathlib import Path
 from shapely import wkt
-import s3fs
 from src.gelos_config import GELOSConfig
-
-s3 = s3fs.S3FileSystem(anon=True)
+from src.utils.events import EventLog
+from src.utils.tables import read_table, table_path, write_table
 
 def _construct_file_paths(row, modality: str) -> str:
     date_list = row[f"{modality}_dates"].split(",")
@@ -24,13 +25,6 @@ def _construct_dem_path(row) -> str:
     dem_list = f"dem_{id:06}.tif"
     return dem_list
 
-def drop_rows(metadata_df, lulc_class, count_to_drop):
-    import random
-    index_to_drop = random.sample(sorted(metadata_df[metadata_df.lulc==lulc_class].index.values), count_to_drop)
-    metadata_df = metadata_df.drop(index_to_drop)
-
-    return metadata_df
-
 def filter_by_n_dates(row, modality, required_dates=4):
     # helper function to check number of dates for a modality
     return required_dates == len(row[f'{modality}_dates'].split(','))
@@ -74,8 +68,13 @@ class DataCleaner:
         self.version = self.config.dataset.version
         self.working_dir = Path(self.config.directory.working)
         self.output_dir = Path(self.config.directory.output)
-        
-    def clean(self):
+        self.table_formats = self.config.directory.table_formats
+        self.tracker_path = table_path(self.output_dir / self.version, 'gelos_chip_tracker', self.table_formats[0])
+        self.manifest_path = self.output_dir / self.version / 'publish_manifest.json'
+        self.events = EventLog(self.working_dir / self.version / 'events.jsonl')
+
+    def load_metadata(self):
+        """Load chip metadata from the working directory and keep only valid chips"""
         metadata_df = pd.read_csv(self.working_dir / self.version / "chip_metadata.csv")
         metadata_df['chip_footprint'] = gpd.GeoSeries(metadata_df['chip_footprint'].dropna().map(wkt.loads), crs=4326)
         metadata_gdf = gpd.GeoDataFrame(metadata_df, geometry = 'chip_footprint', crs=4326)
@@ -89,33 +88,54 @@ class DataCleaner:
             metadata_gdf = metadata_gdf[
                 metadata_gdf.apply(lambda row: filter_by_n_dates(row, modality, required_dates=4), axis=1)
             ]
-        
+        return metadata_gdf
+
+    def balance(self, metadata_gdf, published_counts=None):
+        """
+        Drop chips so class counts fall within the sampling factor. Counts include chips which
+        were already published, but chips are only dropped from metadata_gdf.
+        """
         # get sampling factor, max count, and min count
         sampling_factor = self.config.lulc.sampling_factor
-        if sampling_factor:
-            max_count = metadata_gdf.groupby("lulc").count().max().iloc[0]
-            min_count = metadata_gdf.groupby("lulc").count().min().iloc[0]
-            
-            # use sampling factor to calculate correction factor, for proportional class drop quantities
-            max_distance = max_count - min_count
-            max_end_value = min_count * sampling_factor
-            max_distance_to_max_end_value = max_count - max_end_value
-            correction_factor = max_distance_to_max_end_value / max_distance
+        if not sampling_factor:
+            return metadata_gdf
+
+        new_counts = metadata_gdf['lulc'].value_counts()
+        class_counts = new_counts
+        if published_counts is not None:
+            class_counts = class_counts.add(published_counts, fill_value=0).astype(int)
+        max_count = class_counts.max()
+        min_count = class_counts.min()
             
-            # use correction factor to determine proportion of samples above min to drop for each class
-            # the number of samples dropped will be proportional to the number of samples above minimum
-            # this scales the number of samples between min and min * sampling factor
-            if max_distance_to_max_end_value > 0:
-                    
-                for index, row in metadata_gdf.groupby("lulc").count().iterrows():
-                    lulc_class = index
-                    class_count = row['chip_index']
-                    class_distance = class_count - min_count
-                    drop_quantity = int(correction_factor * class_distance)
-                    metadata_gdf = drop_rows(metadata_gdf, lulc_class, drop_quantity)
+        # use sampling factor to calculate correction factor, for proportional class drop quantities
+        max_distance = max_count - min_count
+        max_end_value = min_count * sampling_factor
+        max_distance_to_max_end_value = max_count - max_end_value
             
-        # create metadata columns
-        metadata_gdf['id'] = np.arange(0, len(metadata_gdf))
+        # use correction factor to determine proportion of samples above min to drop for each class
+        # the number of samples dropped will be proportional to the number of samples above minimum
+        # this scales the number of samples between min and min * sampling factor
+        if max_distance_to_max_end_value <= 0:
+            return metadata_gdf
+        correction_factor = max_distance_to_max_end_value / max_distance
+        drop_counts = (correction_factor * (class_counts - min_count)).astype(int)
+        # published chips are never dropped
+        drop_counts = np.minimum(drop_counts, new_counts.reindex(drop_counts.index, fill_value=0))
+
+        # rank the chips of each class in a seeded random order, independent of the row order, and
+        # drop the first drop_counts[class] chips of each class
+        rng = np.random.default_rng(self.config.lulc.sampling_seed)
+        order = np.argsort(metadata_gdf['chip_index'].to_numpy(), kind='stable')[rng.permutation(len(metadata_gdf))]
+        lulc_values = metadata_gdf['lulc'].to_numpy()[order]
+        ranks = pd.Series(lulc_values).groupby(lulc_values).cumcount().to_numpy()
+        drop = np.zeros(len(metadata_gdf), dtype=bool)
+        drop[order] = ranks < drop_counts.reindex(lulc_values, fill_value=0).to_numpy()
+        return metadata_gdf[~drop]
+
+    def enrich(self, metadata_gdf, start_id=0):
+        """Assign release ids and create the tracker metadata columns"""
+        metadata_gdf = metadata_gdf.copy()
+        metadata_gdf['id'] = np.arange(start_id, start_id + len(metadata_gdf))
         metadata_gdf['lat'] = metadata_gdf.geometry.centroid.y
         metadata_gdf['lon'] = metadata_gdf.geometry.centroid.x
         metadata_gdf = metadata_gdf.rename(columns={"chip_index": "original_id"})
@@ -140,26 +160,132 @@ class DataCleaner:
             metadata_gdf[f"{modality}_paths"] = metadata_gdf.apply(
                 _construct_file_paths, modality=modality, axis=1
             )
+        return metadata_gdf
 
-        (self.output_dir / self.version).mkdir(exist_ok=True)
-        
-        # save to geojson
-        metadata_gdf.to_file(self.output_dir / f'{self.version}/gelos_chip_tracker.geojson', driver='GeoJSON', index=False)
+    def load_manifest(self):
+        """Load the publish manifest of the previous release, if incremental publishing is enabled"""
+        if self.config.publish.incremental and self.manifest_path.exists() and self.tracker_path.exists():
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        return {"next_id": 0, "files": {}}
 
-        # move files to destination folder
+    def release_files(self, row):
+        """Yields source and destination paths of every file belonging to a chip in the release"""
+        for col in ["s2l2a_dates", "s1rtc_dates", "lc2l2_dates"]:
+            for i, date in enumerate(row[col].split(',')):
+                platform = col[:-6]
+                for extension in ["tif", "png"]:
+                    src_file = self.working_dir / self.version / f"{platform}_{row['original_id']:06}_{i}_{date}.{extension}"
+                    dst_file = self.output_dir / self.version / f"{platform}_{row['id']:06}_{date}.{extension}"
+                    yield src_file, dst_file
+        src_file = self.working_dir / self.version / f"dem_{row['original_id']:06}.tif"
+        dst_file = self.output_dir / self.version / f"dem_{row['id']:06}.tif"
+        yield src_file, dst_file
+
+    def copy_files(self, metadata_gdf, copied_files):
+        """Copy chip files to the release, skipping files whose source is unchanged since the last copy"""
+        n_files, n_bytes = 0, 0
         for index, row in tqdm(metadata_gdf.iterrows(), total=len(metadata_gdf), desc="copying files to output dir..."):
-            for col in ["s2l2a_dates", "s1rtc_dates", "lc2l2_dates"]:
-                for i, date in enumerate(row[col].split(',')):
-                    platform = col[:-6]
-                    src_file = self.working_dir / self.version / f"{platform}_{row['original_id']:06}_{i}_{date}.tif"
-                    dst_file = self.output_dir / self.version / f"{platform}_{row['id']:06}_{date}.tif"
-                    shutil.copy2(src_file, dst_file)
-                    src_file = self.working_dir / self.version / f"{platform}_{row['original_id']:06}_{i}_{date}.png"
-                    dst_file = self.output_dir / self.version / f"{platform}_{row['id']:06}_{date}.png"
-                    shutil.copy2(src_file, dst_file)
-            src_file = self.working_dir / self.version / f"dem_{row['original_id']:06}.tif"
-            dst_file = self.output_dir / self.version / f"dem_{row['id']:06}.tif"
-            shutil.copy2(src_file, dst_file)
+            for src_file, dst_file in self.release_files(row):
+                src_stat = src_file.stat()
+                signature = [src_stat.st_size, src_stat.st_mtime_ns]
+                if dst_file.exists() and copied_files.get(dst_file.name) == signature:
+                    continue
+                shutil.copy2(src_file, dst_file)
+                copied_files[dst_file.name] = signature
+                n_files += 1
+                n_bytes += src_stat.st_size
+        self.events.emit("files_copied", files=n_files, bytes=n_bytes)
+        return copied_files
+
+    def read_chips(self, directory, stem):
+        """Read a table of numbered chips, indexed by chip id"""
+        chips_gdf = read_table(directory, stem, self.table_formats)
+        if chips_gdf.geometry.name != 'chip_footprint':
+            chips_gdf = chips_gdf.rename_geometry('chip_footprint')
+        # GeoJSON files without features do not keep their columns
+        if 'id' in chips_gdf:
+            chips_gdf.index = chips_gdf['id']
+        return chips_gdf
+
+    def save_manifest(self, manifest):
+        """Replace the publish manifest atomically, so an interrupted publish keeps the previous one"""
+        tmp_path = self.manifest_path.with_name(f"{self.manifest_path.stem}.{os.getpid()}.tmp.json")
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def unpublished_chips(self):
+        """Number of chips selected by the last clean which are not in the release tracker"""
+        working_dir = self.working_dir / self.version
+        if not table_path(working_dir, 'release_chips', self.table_formats[0]).exists():
+            return 0
+        release_gdf = self.read_chips(working_dir, 'release_chips')
+        if 'original_id' not in release_gdf or not len(release_gdf):
+            return 0
+        if not self.tracker_path.exists():
+            return len(release_gdf)
+        tracker_gdf = self.read_chips(self.output_dir / self.version, 'gelos_chip_tracker')
+        published_ids = tracker_gdf['original_id'] if 'original_id' in tracker_gdf else []
+        return int((~release_gdf['original_id'].isin(published_ids)).sum())
+
+    def published_tracker(self, manifest):
+        """The tracker of the previous release in incremental mode"""
+        if manifest["next_id"] == 0:
+            return None
+        return self.read_chips(self.output_dir / self.version, 'gelos_chip_tracker')
+
+    def clean(self):
+        """
+        Select, balance and number the chips of the release and save them as release_chips in the
+        working directory, for the publish stage
+        """
+        unpublished = self.unpublished_chips()
+        if unpublished:
+            print(f"warning: replacing release_chips, {unpublished} chips selected by the last clean were not published")
+        metadata_gdf = self.load_metadata()
+        manifest = self.load_manifest()
+        self.events.emit("clean_start", chips=len(metadata_gdf), incremental=manifest["next_id"] > 0)
+
+        # in incremental mode published chips keep their ids, only new chips are balanced and appended
+        published_gdf = self.published_tracker(manifest)
+        if published_gdf is not None:
+            metadata_gdf = metadata_gdf[~metadata_gdf['chip_index'].isin(published_gdf['original_id'])]
+            published_counts = published_gdf['lulc'].astype(int).value_counts()
+        else:
+            published_counts = None
+
+        metadata_gdf = self.balance(metadata_gdf, published_counts)
+        metadata_gdf = self.enrich(metadata_gdf, start_id=manifest["next_id"])
+        print(f"selected {len(metadata_gdf)} new chips")
+        write_table(metadata_gdf, self.working_dir / self.version, 'release_chips', self.table_formats[:1])
+        return metadata_gdf
+
+    def publish(self):
+        """
+        Copy the chips selected by clean to the release directory and write the chip tracker.
+        Publishing the same release chips again leaves the release unchanged.
+        """
+        metadata_gdf = self.read_chips(self.working_dir / self.version, 'release_chips')
+        manifest = self.load_manifest()
+        published_gdf = self.published_tracker(manifest)
+        if published_gdf is not None:
+            # chips of a publish which was repeated, or interrupted after writing the tracker
+            metadata_gdf = metadata_gdf[~metadata_gdf['original_id'].isin(published_gdf['original_id'])]
+        print(f"publishing {len(metadata_gdf)} new chips")
+        new_chips = len(metadata_gdf)
+        if published_gdf is not None:
+            metadata_gdf = pd.concat([published_gdf, metadata_gdf])
+
+        (self.output_dir / self.version).mkdir(exist_ok=True)
+
+        # move files to destination folder, then save the tracker in every configured table format
+        # and the manifest, so the tracker never lists chips whose files were not copied
+        manifest["files"] = self.copy_files(metadata_gdf, manifest["files"])
+        manifest["next_id"] = int(metadata_gdf['id'].max()) + 1 if len(metadata_gdf) else 0
+        write_table(metadata_gdf, self.output_dir / self.version, 'gelos_chip_tracker', self.table_formats)
+        self.save_manifest(manifest)
+        self.events.emit("clean_finish", new_chips=new_chips, published_chips=len(metadata_gdf))
         
         # zip folder
         if self.config.directory.zip_output:
@@ -171,6 +297,7 @@ def main():
     config = GELOSConfig.from_yaml('/app/config.yml')
     cleaner = DataCleaner(config)
     cleaner.clean()
+    cleaner.publish()
 
 if __name__ == '__main__':
     main()
@@ -1,98 +1,414 @@
 import pystac_client
 from urllib3 import Retry
-from pystac_client.stac_api_io import StacApiIO
-import planetary_computer
 import pandas as pd
 import geopandas as gpd
 from dask.distributed import Client, LocalCluster
 import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import cached_property
 from pathlib import Path
 import shutil
 
 from src.gelos_config import GELOSConfig
 from src.aoi_processor import AOI_Processor
+from src.work_queue import AOIWorkQueue
+from src.utils.footprints import FootprintIndex
+from src.utils.stack import build_gdal_env
+from src.utils.memory import MemoryBudget
+from src.utils.stack_cache import StackCache
+from src.utils.negative_cache import NegativeResultCache
+from src.utils.chip_store import ChipStore
+from src.utils.tables import read_table, table_path, write_table
+from src.utils.events import EventLog
+from src.utils.stac_io import PooledStacApiIO, RateLimiter
+from src.prefetcher import SearchPrefetcher
+from src.scheduler import AOIScheduler
+
+CHIP_METADATA_COLUMNS = [
+    'chip_index',
+    'aoi_index',
+    's2l2a_dates',
+    's1rtc_dates',
+    'lc2l2_dates',
+    'lulc',
+    'chip_footprint',
+    'epsg',
+    'status',
+]
 
 class Downloader:
-    """This class handles data selection and download for GELOS."""
-    def __init__(self, config: GELOSConfig):
+    """
+    This class handles data selection and download for GELOS. A dry_run Downloader, used to plan
+    runs, only reads the AOI table and leaves the files a run resumes from untouched.
+    """
+    def __init__(self, config: GELOSConfig, dry_run=False):
         self.config = config    
         self.working_directory = Path(self.config.directory.working) / self.config.dataset.version
+        self.table_formats = self.config.directory.table_formats
 
-        # start dask cluster
-        self.cluster = LocalCluster(silence_logs=logging.ERROR)
-        self.client = Client(self.cluster)
+        # the dask cluster is started by the stages which compute stacks, see start_cluster
+        self.cluster = None
+        self.client = None
 
         # set retry policy for pystac catalog client
         retry = Retry(
             total=10, backoff_factor=1, status_forcelist=[502, 503, 504], allowed_methods=None
         )
         
-        # initialize pystac client with retry policy
-        stac_api_io = StacApiIO(max_retries=retry)
-        self.catalog = pystac_client.Client.open(
-            "https://planetarycomputer.microsoft.com/api/stac/v1",
-            modifier=planetary_computer.sign_inplace,
-            stac_io=stac_api_io
+        # initialize pystac client with retry policy, pooled connections and an optional rate limit.
+        # items are not signed at search time, stack readers sign hrefs with cached tokens right before reading
+        rate_limiter = None
+        if self.config.search.requests_per_second:
+            rate_limiter = RateLimiter(self.config.search.requests_per_second, self.config.search.burst)
+        self.stac_api_io = PooledStacApiIO(
+            max_retries=retry,
+            pool_maxsize=self.config.search.pool_maxsize,
+            rate_limiter=rate_limiter,
         )
-        
+
+        self.scheduler = None
+        if self.config.schedule.enabled and not dry_run:
+            self.scheduler = AOIScheduler(self.config, self.catalog, build_gdal_env(self.config.io))
+
+        self.queue = None
+        # handle the case where a run is planned, the AOI table is read but no run state is created
+        if dry_run:
+            self.aoi_path = table_path(self.working_directory, 'aoi_metadata', self.table_formats[0])
+            if self.aoi_path.exists():
+                self.aoi_gdf = read_table(self.working_directory, 'aoi_metadata', self.table_formats)
+            else:
+                self.aoi_gdf = self._load_aois()
+            self.footprint_index = self.events = self.stack_cache = self.negative_cache = None
+            self.chip_store = self.memory_budget = None
+            self.pending_footprints = {}
+            return
+
+        # handle the case where several workers share the working directory through a work queue
+        if self.config.queue.enabled:
+            self._init_queue()
+
         # handle the case where the script is continuing an existing download operation
-        if (self.working_directory / 'chip_metadata.csv').exists():
-            self.aoi_path = (self.working_directory / 'aoi_metadata.geojson')
-            self.aoi_gdf = gpd.read_file(self.aoi_path)
+        elif (self.working_directory / 'chip_metadata.csv').exists():
+            self.aoi_path = table_path(self.working_directory, 'aoi_metadata', self.table_formats[0])
+            self.aoi_gdf = read_table(self.working_directory, 'aoi_metadata', self.table_formats)
             self.chip_metadata_path = self.working_directory / 'chip_metadata.csv'
             self.chip_metadata_df = pd.read_csv(self.chip_metadata_path)
-            # drop aoi which already have chips generated
-            self.aoi_processing_gdf = self.aoi_gdf[self.aoi_gdf.index > self.chip_metadata_df['aoi_index'].max()]
+            # drop aoi which were already processed, AOIs are not necessarily processed in index order
+            self.aoi_processing_gdf = self.aoi_gdf[self.aoi_gdf['status'] == 'not processed']
             self.chip_index = self.chip_metadata_df['chip_index'].max() + 1
 
         # handle the case where the script is starting a new download operation
         else:
-            aoi_path = (f'/app/data/raw/map_{self.config.aoi.version}.geojson')
-            self.aoi_gdf = gpd.read_file(aoi_path)
-            if self.config.aoi.exclude_indices:
-                self.aoi_gdf = self.aoi_gdf.drop(self.config.aoi.exclude_indices)
-            if self.config.aoi.include_indices:
-                self.aoi_gdf = self.aoi_gdf.loc[self.config.aoi.include_indices]
-            self.aoi_gdf['status'] = 'not processed'
-            self.aoi_gdf.to_file(self.working_directory / 'aoi_metadata.geojson', driver = 'GeoJSON')
+            self.aoi_gdf = self._load_aois()
+            write_table(self.aoi_gdf, self.working_directory, 'aoi_metadata', self.table_formats)
             self.aoi_processing_gdf = self.aoi_gdf
-            self.chip_metadata_df = pd.DataFrame(columns=[
-                        'chip_index',
-                        'aoi_index',
-                        's2l2a_dates',
-                        's1rtc_dates',
-                        'lc2l2_dates',
-                        'lulc',
-                        'chip_footprint',
-                        'epsg',
-                        'status',
-                ])
+            self.chip_metadata_df = pd.DataFrame(columns=CHIP_METADATA_COLUMNS)
             self.chip_index = 0
-            self.aoi_path = self.working_directory / 'aoi_metadata.geojson'
+            self.aoi_path = table_path(self.working_directory, 'aoi_metadata', self.table_formats[0])
             self.chip_metadata_path = self.working_directory / 'chip_metadata.csv'
 
-    
+        self.footprint_index = self._init_footprint_index()
+        # footprints of the chips of processed AOIs, added to the index once their chips are saved
+        self.pending_footprints = {}
+        # guards chip metadata and pending footprints when a queue worker processes AOIs in threads
+        self._results_lock = threading.Lock()
+        self.events = EventLog(self.working_directory / 'events.jsonl', self.queue.worker_id if self.queue else None)
+        self.stack_cache = self._init_stack_cache()
+        self.negative_cache = self._init_negative_cache()
+        self.chip_store = ChipStore(self.config.chip_store.directory or Path(self.config.directory.working) / 'chip_store') if self.config.chip_store.enabled else None
+        self.memory_budget = MemoryBudget(self.config.memory.budget_gb * 1e9) if self.config.memory.budget_gb else None
+
+    @cached_property
+    def catalog(self):
+        """STAC client, opened on first use so runs from cached searches never contact the API"""
+        return pystac_client.Client.open(
+            "https://planetarycomputer.microsoft.com/api/stac/v1",
+            stac_io=self.stac_api_io
+        )
+
+    def start_cluster(self):
+        """Start the local dask cluster which computes stacks, once per Downloader"""
+        if self.client is None:
+            self.cluster = LocalCluster(silence_logs=logging.ERROR)
+            self.client = Client(self.cluster)
+
+    def _init_footprint_index(self):
+        """Open the run-wide index of accepted chip footprints, adding saved chips missing from it"""
+        if self.config.chips.duplicate_overlap is None:
+            return None
+        index_path = self.working_directory / 'chip_footprints.tsv'
+        footprint_index = FootprintIndex(index_path, overlap_threshold=self.config.chips.duplicate_overlap)
+        # runs started before the index existed, or stopped between saving chip metadata and adding
+        # its footprints, only have their footprints in chip metadata
+        accepted = self.chip_metadata_df[self.chip_metadata_df['status'] == 'success']
+        footprint_index.extend({
+            chip_index: footprint
+            for chip_index, footprint in zip(accepted['chip_index'], accepted['chip_footprint'])
+            if chip_index not in footprint_index
+        })
+        return footprint_index
+
+    def commit_footprints(self):
+        """Add the footprints of processed AOIs to the run-wide index, after their chips are saved"""
+        if self.footprint_index is not None:
+            self.footprint_index.extend(self.pending_footprints)
+        self.pending_footprints = {}
+
+    def _init_stack_cache(self):
+        """Open the local cache of computed stacks, shared by all dataset versions by default"""
+        if not self.config.cache.enabled:
+            return None
+        directory = self.config.cache.directory or Path(self.config.directory.working) / 'stack_cache'
+        return StackCache(directory, self.config.cache.max_gb * 1e9)
+
+    def _init_negative_cache(self):
+        """Open the cache of deterministic AOI failures, shared by all dataset versions by default"""
+        if not self.config.negative_cache.enabled:
+            return None
+        path = self.config.negative_cache.path or Path(self.config.directory.working) / 'negative_results.sqlite'
+        return NegativeResultCache(path, self.config, force=self.config.negative_cache.force)
+
+    def _load_aois(self):
+        """Read the versioned AOI map and apply include/exclude filters"""
+        aoi_path = (f'/app/data/raw/map_{self.config.aoi.version}.geojson')
+        aoi_gdf = gpd.read_file(aoi_path)
+        if self.config.aoi.exclude_indices:
+            aoi_gdf = aoi_gdf.drop(self.config.aoi.exclude_indices)
+        if self.config.aoi.include_indices:
+            aoi_gdf = aoi_gdf.loc[self.config.aoi.include_indices]
+        aoi_gdf['status'] = 'not processed'
+        return aoi_gdf
+
+    def _init_queue(self):
+        """Set up the shared work queue and this worker's chip metadata part"""
+        self.aoi_path = table_path(self.working_directory, 'aoi_metadata', self.table_formats[0])
+        if not self.aoi_path.exists():
+            # tables are written to a temporary file first, so other workers never read a partial file
+            write_table(self._load_aois(), self.working_directory, 'aoi_metadata', self.table_formats)
+        self.aoi_gdf = read_table(self.working_directory, 'aoi_metadata', self.table_formats)
+
+        queue_path = self.config.queue.path or self.working_directory / 'work_queue.sqlite'
+        self.queue = AOIWorkQueue(
+            queue_path,
+            worker_id=self.config.queue.worker_id,
+            lease_seconds=self.config.queue.lease_seconds,
+            heartbeat_seconds=self.config.queue.heartbeat_seconds,
+            max_attempts=self.config.queue.max_attempts,
+        )
+        if self.scheduler:
+            # queue priority follows the expected yield, AOIs not expected to contribute are not queued
+            ordered, skipped, unestimated = self.scheduler.order(self.aoi_gdf, self.scheduler.targets)
+            print(f"queueing {len(ordered)} AOIs, {len(skipped)} AOIs are not expected to contribute to class targets")
+            if unestimated:
+                print(f"{len(unestimated)} AOIs could not be estimated and are queued last")
+            self.queue.initialize(ordered)
+        else:
+            self.queue.initialize(self.aoi_gdf.index)
+
+        # each worker appends to its own part, parts are merged by finalize_queue
+        parts_directory = self.working_directory / 'chip_metadata_parts'
+        parts_directory.mkdir(exist_ok=True)
+        self.chip_metadata_path = parts_directory / f'{self.queue.worker_id}.csv'
+        if self.chip_metadata_path.exists():
+            self.chip_metadata_df = pd.read_csv(self.chip_metadata_path)
+        else:
+            self.chip_metadata_df = pd.DataFrame(columns=CHIP_METADATA_COLUMNS)
+        self.chip_index = None
+
     def download(self):
-        """Download data for all AOIs that have not yet been processed from the AOI GeoJSON file"""
-        for aoi_index, aoi in self.aoi_processing_gdf.iterrows():
-
-            aoi_processor = AOI_Processor(
-                aoi_index,
-                aoi,
-                self.chip_index,
-                self.working_directory,
-                self.catalog,
-                self.config,
-            )
-            try:
-                aoi_chip_df = aoi_processor.process_aoi()
+        """Download data for all AOIs that have not yet been processed from the AOI metadata table"""
+        self.start_cluster()
+        pending = self.queue.pending() if self.queue else len(self.aoi_processing_gdf)
+        self.events.emit("run_start", aois=pending, total_aois=len(self.aoi_gdf), version=self.config.dataset.version)
+        try:
+            if self.queue:
+                # AOI metadata is written in every format when the worker results are merged
+                self.download_from_queue()
+                return
+            if self.scheduler:
+                self.download_scheduled()
+            elif self.config.search.prefetch:
+                prefetcher = SearchPrefetcher(self.new_processor, self.config.search.prefetch)
+                for aoi_index, aoi, aoi_processor in prefetcher(self.aoi_processing_gdf.iterrows()):
+                    self.process_and_save(aoi_index, aoi, aoi_processor)
+            else:
+                for aoi_index, aoi in self.aoi_processing_gdf.iterrows():
+                    self.process_and_save(aoi_index, aoi)
+            self.save_aoi_metadata(all_formats=True)
+        finally:
+            self.events.emit("run_finish")
+
+    def search(self):
+        """
+        Search every AOI which is not processed yet and save its scene selection next to the AOI
+        metadata, for the chip stage. AOIs whose search fails are searched again by the chip stage.
+        """
+        aois = self.aoi_gdf[self.aoi_gdf['status'] == 'not processed']
+        searched, failed = 0, 0
+        prefetcher = SearchPrefetcher(self.new_processor, max(self.config.search.prefetch, 1))
+        for aoi_index, aoi, aoi_processor in prefetcher(aois.iterrows()):
+            if aoi_processor.search_error is not None:
+                print(f"search failed for AOI {aoi_index}: {aoi_processor.search_error}")
+                if self.negative_cache is not None:
+                    self.negative_cache.record(aoi_index, aoi.geometry, str(aoi_processor.search_error))
+                failed += 1
+            else:
+                searched += 1
+        print(f"searched {searched} AOIs, {failed} searches failed")
+
+    def download_scheduled(self):
+        """Process AOIs in order of expected contribution to class targets until no AOI contributes"""
+        pending_gdf = self.aoi_processing_gdf
+        while len(pending_gdf):
+            remaining = self.scheduler.remaining(self.chip_metadata_df)
+            aoi_index = self.scheduler.next_aoi(pending_gdf, remaining)
+            if aoi_index is None:
+                break
+            self.process_and_save(aoi_index, pending_gdf.loc[aoi_index])
+            pending_gdf = pending_gdf.drop(aoi_index)
+
+        # AOIs left over are not expected to add chips to any class below its target
+        self.aoi_gdf.loc[pending_gdf.index, 'status'] = 'skipped: class targets met'
+        self.save_aoi_metadata()
+
+    def save_aoi_metadata(self, all_formats=False):
+        """Write AOI statuses, only in the primary table format while AOIs are being processed"""
+        formats = self.table_formats if all_formats else self.table_formats[:1]
+        write_table(self.aoi_gdf, self.working_directory, 'aoi_metadata', formats)
+
+    def process_and_save(self, aoi_index, aoi, aoi_processor=None):
+        """Process an AOI and persist its status and the chip metadata"""
+        aoi_status = self.process(aoi_index, aoi, aoi_processor)
+        self.aoi_gdf.loc[aoi_index, 'status'] = aoi_status
+        self.save_aoi_metadata()
+        self.chip_metadata_df.to_csv(self.chip_metadata_path, index=False)
+        self.commit_footprints()
+
+    def download_from_queue(self):
+        """Lease AOIs from the shared work queue until it is drained"""
+        self.queue.start_heartbeat()
+        try:
+            leased = ((aoi_index, self.aoi_gdf.loc[aoi_index]) for aoi_index in iter(self.queue.lease, None))
+            if self.config.search.prefetch:
+                # AOIs searched ahead stay leased, their leases are renewed by the heartbeat
+                leased = SearchPrefetcher(self.new_processor, self.config.search.prefetch)(leased)
+            else:
+                leased = ((aoi_index, aoi, None) for aoi_index, aoi in leased)
+            if self.config.queue.threads > 1:
+                self.process_concurrently(leased, self.config.queue.threads)
+            else:
+                for aoi_index, aoi, aoi_processor in leased:
+                    self.process_leased(aoi_index, aoi, aoi_processor)
+        finally:
+            self.queue.stop_heartbeat()
+
+    def process_concurrently(self, leased, threads):
+        """
+        Process leased AOIs in threads, leasing the next AOI once a thread is free. The computed
+        stacks of the AOIs share the memory budget, chipping waits while the others would exceed it.
+        """
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="aoi") as executor:
+            running = set()
+            for aoi_index, aoi, aoi_processor in leased:
+                running.add(executor.submit(self.process_leased, aoi_index, aoi, aoi_processor))
+                if len(running) >= threads:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+            for future in running:
+                future.result()
+
+    def process_leased(self, aoi_index, aoi, aoi_processor=None):
+        """Process a leased AOI, persist the chip metadata and complete its lease"""
+        aoi_processor = aoi_processor or self.new_processor(aoi_index, aoi)
+        aoi_status = self.process(aoi_index, aoi, aoi_processor)
+        # write chip metadata before completing the lease, so a crash never loses finished work
+        with self._results_lock:
+            self.chip_metadata_df.to_csv(self.chip_metadata_path, index=False)
+            self.commit_footprints()
+            self.queue.complete(aoi_index, aoi_status, attempt=aoi_processor.attempt_id)
+
+    def new_processor(self, aoi_index, aoi):
+        """Create the AOI_Processor for an AOI, chip indices are assigned when it is processed"""
+        return AOI_Processor(
+            aoi_index,
+            aoi,
+            None,
+            self.working_directory,
+            self.catalog,
+            self.config,
+            chip_index_allocator=self.queue.reserve_chip_indices if self.queue else None,
+            footprint_index=self.footprint_index,
+            memory_budget=self.memory_budget,
+            events=self.events,
+            stack_cache=self.stack_cache,
+            negative_cache=self.negative_cache,
+            chip_store=self.chip_store,
+        )
+
+    def process(self, aoi_index, aoi, aoi_processor=None):
+        """Process a single AOI, append its chips to the chip metadata and return the AOI status"""
+        if self.footprint_index is not None:
+            # pick up chips accepted by other workers
+            self.footprint_index.refresh()
+        aoi_processor = aoi_processor or self.new_processor(aoi_index, aoi)
+        aoi_processor.chip_index = self.chip_index
+        self.events.emit("aoi_start", aoi_index=aoi_index)
+        start = time.perf_counter()
+        chips = 0
+        try:
+            aoi_chip_df = aoi_processor.process_aoi()
+            if self.queue:
+                # rows of attempts which crash before completing their lease are dropped by finalize_queue
+                aoi_chip_df = aoi_chip_df.assign(attempt=aoi_processor.attempt_id)
+            with self._results_lock:
                 self.chip_metadata_df = pd.concat([self.chip_metadata_df, aoi_chip_df], ignore_index=True)
-                self.chip_index += len(aoi_chip_df)
-                aoi_status = 'success'
-            except Exception as e:
-                print(e)
-                aoi_status = str(e)
-            finally:
-                self.aoi_gdf.loc[aoi_index, 'status'] = aoi_status
-                self.aoi_gdf.to_file(self.aoi_path, driver='GeoJSON')
-                self.chip_metadata_df.to_csv(self.chip_metadata_path, index=False)
\ No newline at end of file
+                if self.chip_index is not None:
+                    self.chip_index += len(aoi_chip_df)
+                if aoi_processor.accepted_footprints is not None:
+                    self.pending_footprints.update(aoi_processor.accepted_footprints.footprints)
+            chips = int((aoi_chip_df['status'] == 'success').sum()) if len(aoi_chip_df) else 0
+            aoi_status = 'success'
+        except Exception as e:
+            print(e)
+            aoi_status = str(e)
+            if self.negative_cache is not None:
+                self.negative_cache.record(aoi_index, aoi.geometry, aoi_status)
+        if self.stack_cache is not None:
+            # entries are sized once per AOI rather than after every cached window
+            self.stack_cache.evict()
+        self.events.emit(
+            "aoi_finish", aoi_index=aoi_index, status=aoi_status, chips=chips,
+            seconds=round(time.perf_counter() - start, 1),
+        )
+        return aoi_status
+
+    def finalize_queue(self):
+        """
+        Merge worker chip metadata parts and AOI statuses into chip_metadata.csv and aoi_metadata.
+        Returns False if AOIs are still being processed or another worker already merged the results.
+        """
+        if not self.queue.is_finished():
+            print("AOIs are still leased by other workers, skipping merge")
+            return False
+        if not self.queue.claim_finalize():
+            print("results were already merged by another worker")
+            return False
+
+        parts = sorted((self.working_directory / 'chip_metadata_parts').glob('*.csv'))
+        # workers which processed no AOI wrote no part
+        chip_metadata_df = pd.concat(
+            [pd.read_csv(part) for part in parts] or [pd.DataFrame(columns=CHIP_METADATA_COLUMNS)],
+            ignore_index=True,
+        )
+        # AOIs whose last lease expired are otherwise left leased, and not processed in the results
+        self.queue.expire_leases()
+        chip_metadata_df = self.queue.completed_rows(chip_metadata_df).sort_values('chip_index')
+        chip_metadata_df.to_csv(self.working_directory / 'chip_metadata.csv', index=False)
+
+        for aoi_index, aoi_status in self.queue.results().items():
+            self.aoi_gdf.loc[aoi_index, 'status'] = aoi_status
+        self.save_aoi_metadata(all_formats=True)
+        return True
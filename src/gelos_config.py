@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 import yaml
 import numpy as np
 
@@ -44,16 +44,23 @@ class LC2L2Config(PlatformConfig):
 @dataclass
 class DEMConfig(PlatformConfig):
     year: str
+    composite: str = "mosaic"  # "mosaic" (first valid tile) or "mean" over intersecting tiles
 
 @dataclass
 class LULCConfig(PlatformConfig):
     year: str
     sampling_factor: Optional[int] = None
+    sampling_seed: int = 0  # seed of the random selection of chips dropped when balancing classes
+    composite: str = "mosaic"  # "mosaic" (first valid tile) or "mean" over intersecting tiles
 
 @dataclass
 class ChipConfig:
     sample_size: int
     chip_size: int
+    duplicate_overlap: Optional[float] = 0.5  # fraction of footprint overlap marking a chip as duplicate
+    precheck: bool = False  # skip candidates whose sensor coverage fails in a low resolution read
+    precheck_resolution: int = 120  # meters, resolution of the coverage read
+    sensor_at_a_time: bool = False  # compute and write one sensor stack at a time to bound memory
 
 @dataclass
 class DatasetConfig:
@@ -70,6 +77,103 @@ class DirectoryConfig:
     working: str
     output: str
     zip_output: bool
+    # formats of aoi_metadata and the chip tracker: geojson, parquet, flatgeobuf. The first is read back
+    table_formats: List[str] = field(default_factory=lambda: ["geojson"])
+
+@dataclass
+class IOConfig:
+    """GDAL/HTTP options applied to every remote COG read."""
+    profile: str = "configured"  # named GDAL/HTTP profile from IO_PROFILES, "configured" uses the options below
+    gdal_cachemax: int = 512  # GDAL block cache size in MB
+    vsi_curl_cache_size: int = 200_000_000  # CPL_VSIL_CURL_CACHE_SIZE in bytes
+    http_multiplex: bool = True  # HTTP/2 multiplexing of range requests
+    merge_consecutive_ranges: bool = True
+    disable_read_dir_on_open: bool = True
+    http_timeout: int = 30  # seconds per request
+    http_connect_timeout: int = 10  # seconds
+    http_max_retry: int = 5
+    http_retry_delay: float = 1.0  # seconds
+    cog_block_size: int = 1024  # target spatial chunk edge in pixels
+    chunk_bytes: int = 128_000_000  # upper bound for the size of one dask chunk
+    chunksize: Optional[Dict[str, int]] = None  # per-platform spatial chunk edge overrides in pixels
+    signer: str = "planetary_computer"  # "planetary_computer" signs hrefs at read time, "none" reads them unsigned
+    token_refresh_seconds: int = 600  # request a new SAS token when the cached one expires sooner than this
+    read_retries: int = 3  # retries of a failed window read before it is read as nodata and logged
+    read_retry_delay: float = 1.0  # seconds before the first retry, doubled on every retry
+
+@dataclass
+class ScheduleConfig:
+    """Settings for ordering and skipping AOIs by their expected chip yield per class."""
+    enabled: bool = False
+    class_targets: Dict[int, int] = field(default_factory=dict)  # chips wanted per lulc class
+    estimate_resolution: int = 240  # resolution in meters of the land cover read used to estimate yield
+    previous_version: Optional[str] = None  # dataset version whose chip yields are used as estimates
+
+@dataclass
+class PublishConfig:
+    """Settings for publishing cleaned chips to the output directory."""
+    incremental: bool = False  # append new chips to the previous release instead of rebuilding it
+
+@dataclass
+class QueueConfig:
+    """Settings for the shared AOI work queue used to run several workers on one dataset version."""
+    enabled: bool = False
+    path: Optional[str] = None  # defaults to work_queue.sqlite in the versioned working directory
+    worker_id: Optional[str] = None  # defaults to hostname-pid
+    lease_seconds: int = 900
+    heartbeat_seconds: int = 60
+    max_attempts: int = 3
+    threads: int = 1  # AOIs a worker processes at once, their computed stacks share memory.budget_gb
+
+@dataclass
+class SearchConfig:
+    """Settings for the STAC search stage and the connections it uses."""
+    prefetch: int = 0  # number of AOIs searched ahead of the AOI being processed, 0 searches in line
+    pool_maxsize: int = 10  # keep-alive connections shared by concurrent searches
+    requests_per_second: Optional[float] = None  # no rate limit when unset
+    burst: int = 5
+    cache: bool = False  # save scene selections per AOI and reuse them in later runs and plans
+
+@dataclass
+class QAConfig:
+    """Settings for the QA statistics computed over published chips."""
+    enabled: bool = False
+    workers: Optional[int] = None  # defaults to the number of CPUs
+    batch_size: int = 256  # chips per task sent to a worker
+    bins: int = 256  # histogram bins per band
+    # histogram range per sensor, values outside the range are counted in the edge bins
+    ranges: Dict[str, List[float]] = field(default_factory=lambda: {
+        "s2l2a": [0, 10000],
+        "lc2l2": [0, 1],
+        "s1rtc": [0, 1],
+        "dem": [-500, 9000],
+    })
+
+@dataclass
+class CacheConfig:
+    """Settings for the local Zarr cache of computed AOI stacks."""
+    enabled: bool = False
+    directory: Optional[str] = None  # defaults to stack_cache in the working directory, shared by versions
+    max_gb: float = 100  # least recently used stacks are evicted above this size
+
+@dataclass
+class ChipStoreConfig:
+    """Settings for the content addressed store of chip files shared by dataset versions."""
+    enabled: bool = False
+    directory: Optional[str] = None  # defaults to chip_store in the working directory
+
+@dataclass
+class NegativeCacheConfig:
+    """Settings for the cache of deterministic AOI failures shared by dataset versions."""
+    enabled: bool = False
+    path: Optional[str] = None  # defaults to negative_results.sqlite in the working directory
+    force: bool = False  # ignore cached failures and process every AOI again
+
+@dataclass
+class MemoryConfig:
+    """Settings for keeping the memory of computed stacks under a budget."""
+    budget_gb: Optional[float] = None  # no admission control when unset
+    split: bool = True  # compute AOIs over budget in strips of sample rows instead of skipping them
 
 @dataclass
 class GELOSConfig:
@@ -84,6 +188,16 @@ class GELOSConfig:
     dem: DEMConfig
     lulc: LULCConfig
     chips: ChipConfig
+    io: IOConfig = field(default_factory=IOConfig)
+    queue: QueueConfig = field(default_factory=QueueConfig)
+    publish: PublishConfig = field(default_factory=PublishConfig)
+    schedule: ScheduleConfig = field(default_factory=ScheduleConfig)
+    memory: MemoryConfig = field(default_factory=MemoryConfig)
+    search: SearchConfig = field(default_factory=SearchConfig)
+    qa: QAConfig = field(default_factory=QAConfig)
+    cache: CacheConfig = field(default_factory=CacheConfig)
+    negative_cache: NegativeCacheConfig = field(default_factory=NegativeCacheConfig)
+    chip_store: ChipStoreConfig = field(default_factory=ChipStoreConfig)
 
     @classmethod
     def from_yaml(cls, path: str):
@@ -101,5 +215,15 @@ class GELOSConfig:
             lc2l2=LC2L2Config(**config_dict['lc2l2']),
             dem=DEMConfig(**config_dict.get('dem', {})),
             lulc=LULCConfig(**config_dict.get('lulc', {})),
-            chips=ChipConfig(**config_dict['chips'])
+            chips=ChipConfig(**config_dict['chips']),
+            io=IOConfig(**(config_dict.get('io') or {})),
+            queue=QueueConfig(**(config_dict.get('queue') or {})),
+            publish=PublishConfig(**(config_dict.get('publish') or {})),
+            schedule=ScheduleConfig(**{k: v for k, v in (config_dict.get('schedule') or {}).items() if v is not None}),
+            memory=MemoryConfig(**(config_dict.get('memory') or {})),
+            search=SearchConfig(**(config_dict.get('search') or {})),
+            qa=QAConfig(**{k: v for k, v in (config_dict.get('qa') or {}).items() if v is not None}),
+            cache=CacheConfig(**(config_dict.get('cache') or {})),
+            negative_cache=NegativeCacheConfig(**(config_dict.get('negative_cache') or {})),
+            chip_store=ChipStoreConfig(**(config_dict.get('chip_store') or {})),
         )
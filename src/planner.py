@@ -0,0 +1,122 @@
+import math
+
+import numpy as np
+import pandas as pd
+from shapely.geometry import box, shape
+
+from src.chip_generator import ChipGenerator
+from src.scheduler import AOI_CLASS_LIMIT, LULC_CLASSES
+from src.utils.memory import estimate_stack_nbytes
+
+PLATFORMS = ["s2l2a", "s1rtc", "lc2l2", "dem", "lulc"]
+
+
+def asset_itemsize(item, band, default_dtype):
+    """Bytes per pixel of an asset as stored, from its raster:bands metadata when available"""
+    asset = item.assets.get(band) if band else next(iter(item.assets.values()), None)
+    raster_bands = (asset.extra_fields.get("raster:bands") if asset else None) or [{}]
+    return np.dtype(raster_bands[0].get("data_type", default_dtype)).itemsize
+
+
+class CapacityPlanner:
+    """
+    Dry run which searches each AOI (or reads its cached search) and detects land cover candidate
+    windows, without reading sensor data. Writes per-AOI estimates of candidate chips by class,
+    bytes read per collection, output bytes and request counts to plan.csv.
+    """
+    def __init__(self, downloader):
+        self.downloader = downloader
+        self.config = downloader.config
+        self.plan_path = downloader.working_directory / 'plan.csv'
+
+    def output_nbytes_per_chip(self):
+        """Uncompressed size of the GeoTIFFs written for one chip at the configured dtypes"""
+        chip_bounds = (0, 0, self.config.chips.chip_size, self.config.chips.chip_size)
+        n_times = len(self.config.s2l2a.time_ranges)
+        nbytes = 0
+        for platform in PLATFORMS:
+            platform_config = getattr(self.config, platform)
+            n_bands = len(getattr(platform_config, "bands", None) or [None])
+            if getattr(platform_config, "cloud_band", None):
+                n_bands -= 1
+            platform_times = 1 if platform in ["dem", "lulc"] else n_times
+            nbytes += estimate_stack_nbytes(chip_bounds, platform_config.resolution, n_bands, platform_times, platform_config.dtype)
+        return nbytes
+
+    def read_estimates(self, processor):
+        """Bytes read and COG requests per collection, assuming reads of the overlap of every item"""
+        minx, miny, maxx, maxy = processor.stacks['lc2l2'].rio.bounds()
+        overlap = box(*processor.overlap_bounds)
+        block = self.config.io.cog_block_size
+        estimates = {}
+        for platform, items in processor.itemcollections.items():
+            platform_config = getattr(self.config, platform)
+            bands = getattr(platform_config, "bands", None) or [None]
+            width = math.ceil((maxx - minx) / platform_config.resolution)
+            height = math.ceil((maxy - miny) / platform_config.resolution)
+            n_blocks = math.ceil(width / block) * math.ceil(height / block)
+            read_bytes, requests = 0, 0
+            for item in items:
+                # fraction of the overlap covered by the item, tiles of annual collections cover parts of it
+                fraction = shape(item.geometry).intersection(overlap).area / overlap.area if overlap.area else 1
+                for band in bands:
+                    read_bytes += fraction * width * height * asset_itemsize(item, band, platform_config.dtype)
+                    # one header read per asset and one range request per intersecting block
+                    requests += 1 + math.ceil(fraction * n_blocks)
+            estimates[f"read_bytes_{platform}"] = int(read_bytes)
+            estimates[f"requests_{platform}"] = requests
+        return estimates
+
+    def plan_aoi(self, aoi_index, aoi):
+        """Estimates for one AOI, with the reason when the AOI would not be processed"""
+        row = {"aoi_index": aoi_index}
+        stac_requests = self.downloader.stac_api_io.request_count
+        processor = self.downloader.new_processor(aoi_index, aoi)
+        try:
+            processor.search()
+            processor.stack()
+            chip_generator = ChipGenerator(processor)
+            processor.stacks['lulc'] = chip_generator.compute_stack('lulc', processor.stacks['lulc'])
+            ys, xs = chip_generator.candidate_windows()
+            classes = chip_generator.lulc_min.values[ys, xs]
+            row["status"] = "success"
+        except Exception as e:
+            print(e)
+            row["status"] = str(e)
+            row["requests_stac"] = self.downloader.stac_api_io.request_count - stac_requests
+            return row
+
+        row["requests_stac"] = self.downloader.stac_api_io.request_count - stac_requests
+        expected_chips = 0
+        for lulc_class in LULC_CLASSES:
+            count = int((classes == lulc_class).sum())
+            row[f"candidates_{lulc_class}"] = count
+            expected_chips += min(count, AOI_CLASS_LIMIT)
+        row["expected_chips"] = expected_chips
+        row.update(self.read_estimates(processor))
+        row["output_bytes"] = expected_chips * self.output_nbytes_per_chip()
+        row["memory_bytes"] = sum(processor.memory_estimates.values())
+        return row
+
+    def plan(self):
+        """Plan every AOI of the run, write plan.csv and print run totals"""
+        # land cover stacks are computed to find candidate windows
+        self.downloader.start_cluster()
+        rows = []
+        for aoi_index, aoi in self.downloader.aoi_gdf.iterrows():
+            print(f"\nPlanning AOI at index {aoi_index}")
+            rows.append(self.plan_aoi(aoi_index, aoi))
+            # rewrite after every AOI so long plans can be inspected while they run
+            pd.DataFrame(rows).to_csv(self.plan_path, index=False)
+
+        plan_df = pd.DataFrame(rows)
+        totals = plan_df.drop(columns=["aoi_index", "status"]).sum(numeric_only=True)
+        if "memory_bytes" in plan_df:
+            # AOIs are computed one at a time, the largest AOI sizes the memory of a worker
+            totals["memory_bytes"] = plan_df["memory_bytes"].max()
+        totals["aois"] = len(plan_df)
+        totals["aois_success"] = int((plan_df["status"] == "success").sum())
+        print("\nplan totals:")
+        print(totals.to_string())
+        print(f"plan written to {self.plan_path}")
+        return plan_df
@@ -0,0 +1,41 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SearchPrefetcher:
+    """
+    Runs the STAC search stage of the next `lookahead` AOIs in background threads while the
+    current AOI is stacked and chipped, yielding searched processors in the order of the AOIs.
+    """
+    def __init__(self, make_processor, lookahead):
+        self.make_processor = make_processor
+        self.lookahead = lookahead
+
+    @staticmethod
+    def _search(processor):
+        # search errors are raised by process_aoi, so they are recorded as the AOI status like before
+        try:
+            processor.search()
+        except Exception as e:
+            processor.search_error = e
+        return processor
+
+    def __call__(self, aois):
+        """Yield (aoi_index, aoi, processor) for an iterable of (aoi_index, aoi), searching ahead"""
+        aois = iter(aois)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.lookahead, thread_name_prefix="stac-search") as executor:
+            def submit():
+                for aoi_index, aoi in aois:
+                    processor = self.make_processor(aoi_index, aoi)
+                    pending.append((aoi_index, aoi, executor.submit(self._search, processor)))
+                    return True
+                return False
+
+            # keep the current AOI and `lookahead` AOIs after it in flight
+            while len(pending) <= self.lookahead and submit():
+                pass
+            while pending:
+                aoi_index, aoi, future = pending.popleft()
+                submit()
+                yield aoi_index, aoi, future.result()
@@ -0,0 +1,189 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from tqdm import tqdm
+
+from src.gelos_config import GELOSConfig
+from src.utils.tables import read_table, write_table
+
+SENSORS = ["s2l2a", "s1rtc", "lc2l2", "dem"]
+
+
+def _band_names(config, sensor):
+    platform_config = getattr(config, sensor)
+    bands = getattr(platform_config, "bands", None) or [sensor]
+    return [band for band in bands if band != getattr(platform_config, "cloud_band", None)]
+
+
+def _empty_stats(n_bands, n_bins):
+    return {
+        "count": np.zeros(n_bands, dtype=np.int64),
+        "nodata": np.zeros(n_bands, dtype=np.int64),
+        "sum": np.zeros(n_bands),
+        "sumsq": np.zeros(n_bands),
+        "min": np.full(n_bands, np.inf),
+        "max": np.full(n_bands, -np.inf),
+        "histogram": np.zeros((n_bands, n_bins), dtype=np.int64),
+    }
+
+
+def _merge_stats(total, stats):
+    for key in ["count", "nodata", "sum", "sumsq", "histogram"]:
+        total[key] += stats[key]
+    total["min"] = np.minimum(total["min"], stats["min"])
+    total["max"] = np.maximum(total["max"], stats["max"])
+
+
+def _summarize(stats, band_names, edges=None):
+    """JSON friendly moments of accumulated band statistics"""
+    count = np.maximum(stats["count"], 1)
+    mean = stats["sum"] / count
+    std = np.sqrt(np.maximum(stats["sumsq"] / count - mean ** 2, 0))
+    summary = {}
+    for i, band in enumerate(band_names):
+        summary[band] = {
+            "count": int(stats["count"][i]),
+            "mean": float(mean[i]),
+            "std": float(std[i]),
+            "min": float(stats["min"][i]) if stats["count"][i] else None,
+            "max": float(stats["max"][i]) if stats["count"][i] else None,
+            "nodata_fraction": float(stats["nodata"][i] / max(stats["count"][i] + stats["nodata"][i], 1)),
+        }
+        if edges is not None:
+            summary[band]["histogram"] = {"edges": edges.tolist(), "counts": stats["histogram"][i].tolist()}
+    return summary
+
+
+def _chip_batch_stats(batch, specs, n_bins):
+    """
+    Statistics of a batch of chips, computed in a worker process. Returns per chip and sensor the
+    accumulated band statistics over all dates of the sensor. Histograms use fixed edges per sensor
+    so they can be merged across workers; values outside the range are counted in the edge bins.
+    """
+    results = []
+    for chip_id, paths in batch:
+        chip = {}
+        for sensor, sensor_paths in paths.items():
+            n_bands, nodata, value_range = specs[sensor]
+            stats = _empty_stats(n_bands, n_bins)
+            for path in sensor_paths:
+                with rasterio.open(path) as src:
+                    data = src.read().astype(np.float64).reshape(src.count, -1)
+                valid = np.isfinite(data) & (data != nodata)
+                clipped = np.clip(data, *value_range)
+                bins = np.minimum(((clipped - value_range[0]) / (value_range[1] - value_range[0]) * n_bins).astype(np.int64), n_bins - 1)
+                for band in range(min(n_bands, data.shape[0])):
+                    values = data[band][valid[band]]
+                    stats["count"][band] += values.size
+                    stats["nodata"][band] += data.shape[1] - values.size
+                    if values.size:
+                        stats["sum"][band] += values.sum()
+                        stats["sumsq"][band] += (values ** 2).sum()
+                        stats["min"][band] = min(stats["min"][band], values.min())
+                        stats["max"][band] = max(stats["max"][band], values.max())
+                        stats["histogram"][band] += np.bincount(bins[band][valid[band]], minlength=n_bins)
+            chip[sensor] = stats
+        results.append((chip_id, chip))
+    return results
+
+
+class DatasetQA:
+    """
+    QA statistics over the published chips of a dataset version. Chips are streamed through a
+    process pool in batches, so memory holds only a bounded number of batches and the merged
+    statistics. Writes per-band histograms, moments and nodata fractions overall, per class and
+    per sensor to qa_stats.json, and per-chip outlier and nodata scores back to the tracker.
+    """
+    def __init__(self, config: GELOSConfig):
+        self.config = config
+        self.release_dir = Path(config.directory.output) / config.dataset.version
+        self.table_formats = config.directory.table_formats
+        self.stats_path = self.release_dir / 'qa_stats.json'
+        self.n_bins = config.qa.bins
+        self.band_names = {sensor: _band_names(config, sensor) for sensor in SENSORS}
+        self.specs = {
+            sensor: (len(self.band_names[sensor]), getattr(config, sensor).na_value, tuple(config.qa.ranges[sensor]))
+            for sensor in SENSORS
+        }
+
+    def chip_paths(self, row):
+        return {
+            sensor: [self.release_dir / path for path in row[f"{sensor}_paths"].split(',')]
+            for sensor in SENSORS
+        }
+
+    def batches(self, tracker_gdf):
+        batch_size = self.config.qa.batch_size
+        for start in range(0, len(tracker_gdf), batch_size):
+            rows = tracker_gdf.iloc[start:start + batch_size]
+            yield [(row['id'], self.chip_paths(row)) for _, row in rows.iterrows()]
+
+    def stream(self, tracker_gdf):
+        """Yield (chip id, per sensor stats) with at most two batches per worker in flight"""
+        workers = self.config.qa.workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            for batch in self.batches(tracker_gdf):
+                pending.append(executor.submit(_chip_batch_stats, batch, self.specs, self.n_bins))
+                if len(pending) >= 2 * workers:
+                    yield from pending.pop(0).result()
+            for future in pending:
+                yield from future.result()
+
+    def outlier_scores(self, chip_means, chip_classes):
+        """Largest absolute z-score of a chip's band means against the band means of chips of its class"""
+        scores = {}
+        for sensor, means in chip_means.items():
+            chip_ids = list(means)
+            values = np.array([means[chip_id] for chip_id in chip_ids])
+            classes = np.array([chip_classes[chip_id] for chip_id in chip_ids])
+            for lulc_class in np.unique(classes):
+                in_class = classes == lulc_class
+                class_values = values[in_class]
+                std = np.nanstd(class_values, axis=0)
+                z = np.abs(class_values - np.nanmean(class_values, axis=0)) / np.where(std > 0, std, 1)
+                for chip_id, chip_z in zip(np.array(chip_ids)[in_class], np.nanmax(z, axis=1)):
+                    scores[chip_id] = max(scores.get(chip_id, 0.0), float(chip_z))
+        return scores
+
+    def run(self):
+        tracker_gdf = read_table(self.release_dir, 'gelos_chip_tracker', self.table_formats)
+        chip_classes = dict(zip(tracker_gdf['id'], tracker_gdf['lulc'].astype(str)))
+        edges = {sensor: np.linspace(*self.specs[sensor][2], self.n_bins + 1) for sensor in SENSORS}
+
+        totals = {sensor: _empty_stats(self.specs[sensor][0], self.n_bins) for sensor in SENSORS}
+        class_totals = defaultdict(lambda: {sensor: _empty_stats(self.specs[sensor][0], self.n_bins) for sensor in SENSORS})
+        chip_means = {sensor: {} for sensor in SENSORS}
+        nodata_fractions = {}
+
+        for chip_id, chip in tqdm(self.stream(tracker_gdf), total=len(tracker_gdf), desc="computing QA statistics..."):
+            chip_nodata, chip_pixels = 0, 0
+            for sensor, stats in chip.items():
+                _merge_stats(totals[sensor], stats)
+                _merge_stats(class_totals[chip_classes[chip_id]][sensor], stats)
+                chip_means[sensor][chip_id] = stats["sum"] / np.where(stats["count"] > 0, stats["count"], np.nan)
+                chip_nodata += stats["nodata"].sum()
+                chip_pixels += stats["nodata"].sum() + stats["count"].sum()
+            nodata_fractions[chip_id] = chip_nodata / max(chip_pixels, 1)
+
+        qa_stats = {
+            "sensors": {sensor: _summarize(totals[sensor], self.band_names[sensor], edges[sensor]) for sensor in SENSORS},
+            "classes": {
+                lulc_class: {sensor: _summarize(stats[sensor], self.band_names[sensor]) for sensor in SENSORS}
+                for lulc_class, stats in sorted(class_totals.items())
+            },
+        }
+        with open(self.stats_path, 'w') as f:
+            json.dump(qa_stats, f)
+
+        scores = self.outlier_scores(chip_means, chip_classes)
+        tracker_gdf['qa_outlier_score'] = tracker_gdf['id'].map(scores)
+        tracker_gdf['qa_nodata_fraction'] = tracker_gdf['id'].map(nodata_fractions)
+        write_table(tracker_gdf, self.release_dir, 'gelos_chip_tracker', self.table_formats)
+        print(f"QA statistics written to {self.stats_path}")
+        return qa_stats
@@ -0,0 +1,154 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.gelos_config import GELOSConfig
+from src.utils.search import search_annual_scene
+from src.utils.stack import build_reader, stack_lulc_data
+
+LULC_CLASSES = [1, 2, 5, 7, 8, 11]
+# ChipGenerator stops accepting chips of a class in one AOI after this many
+AOI_CLASS_LIMIT = 401
+
+
+class AOIScheduler:
+    """
+    Orders AOIs so that per-class chip targets are reached with as few AOI downloads as possible.
+
+    Expected chips per class for each AOI are estimated from a low resolution read of the land
+    cover collection, or taken from the chips an AOI produced in a previous dataset version.
+    Estimates are cached in the working directory so they are only computed once per AOI version.
+    AOIs whose estimate failed are remembered for the run only and scheduled after every AOI with
+    an estimate, assuming the mean estimate.
+    """
+    def __init__(self, config: GELOSConfig, catalog, gdal_env=None):
+        self.config = config
+        self.catalog = catalog
+        self.gdal_env = gdal_env
+        self.reader = build_reader(config.io)
+        if not config.schedule.class_targets:
+            raise ValueError("schedule.class_targets must be set to schedule AOIs by yield")
+        self.targets = {int(lulc_class): target for lulc_class, target in config.schedule.class_targets.items()}
+        self.cache_path = Path(config.directory.working) / f"yield_estimates_{config.aoi.version}.csv"
+        self.estimates = self._load_estimates()
+        # AOIs whose estimate failed in this run, not cached so later runs estimate them again
+        self.failed = set()
+
+    def _cache_key(self):
+        return f"{self.config.lulc.collection}|{self.config.lulc.year}|{self.config.chips.sample_size}|{self.config.schedule.estimate_resolution}"
+
+    def _load_estimates(self):
+        """Load cached estimates, preferring observed yields from a previous dataset version"""
+        estimates = {}
+        if self.cache_path.exists():
+            cache_df = pd.read_csv(self.cache_path)
+            cache_df = cache_df[cache_df['key'] == self._cache_key()]
+            for _, row in cache_df.iterrows():
+                estimates[int(row['aoi_index'])] = {c: int(row[str(c)]) for c in LULC_CLASSES}
+
+        if self.config.schedule.previous_version:
+            previous_path = Path(self.config.directory.working) / self.config.schedule.previous_version / 'chip_metadata.csv'
+            previous_df = pd.read_csv(previous_path)
+            previous_df = previous_df[previous_df['status'] == 'success']
+            counts = previous_df.groupby(['aoi_index', 'lulc']).size().unstack(fill_value=0)
+            for aoi_index, row in counts.iterrows():
+                estimates[int(aoi_index)] = {c: int(row.get(c, 0)) for c in LULC_CLASSES}
+        return estimates
+
+    def _save_estimate(self, aoi_index, estimate):
+        row = pd.DataFrame([{'aoi_index': aoi_index, 'key': self._cache_key(), **{str(c): n for c, n in estimate.items()}}])
+        row.to_csv(self.cache_path, mode='a', header=not self.cache_path.exists(), index=False)
+
+    def mean_estimate(self):
+        """Mean estimate of the AOIs estimated so far, assumed for AOIs whose estimate failed"""
+        if not self.estimates:
+            return {c: 0 for c in LULC_CLASSES}
+        return {c: int(round(np.mean([e[c] for e in self.estimates.values()]))) for c in LULC_CLASSES}
+
+    def estimate(self, aoi_index, aoi):
+        """Expected chips per class for one AOI, from a coarse land cover read"""
+        if aoi_index in self.estimates:
+            return self.estimates[aoi_index]
+        if aoi_index in self.failed:
+            return self.mean_estimate()
+
+        resolution = self.config.schedule.estimate_resolution
+        block = max(1, int(self.config.chips.sample_size / resolution))
+        estimate = {c: 0 for c in LULC_CLASSES}
+        try:
+            items = search_annual_scene(aoi.geometry, self.config.lulc.year, self.catalog, self.config.lulc.collection)
+            if items:
+                lulc_stack = stack_lulc_data(
+                    items,
+                    True,
+                    resolution,
+                    None,
+                    aoi.geometry.bounds,
+                    bbox_is_latlon=True,
+                    gdal_env=self.gdal_env,
+                    reader=self.reader,
+                    dtype=self.config.lulc.dtype,
+                    fill_value=self.config.lulc.na_value,
+                ).compute()
+                # a coarse block of a single class approximates a homogeneous sample window
+                coarse = lulc_stack.coarsen(x=block, y=block, boundary="trim")
+                coarse_min = coarse.min().values
+                pure = (coarse_min == coarse.max().values) & (coarse_min > 0)
+                classes, counts = np.unique(coarse_min[pure], return_counts=True)
+                for lulc_class, count in zip(classes, counts):
+                    if int(lulc_class) in estimate:
+                        estimate[int(lulc_class)] = min(int(count), AOI_CLASS_LIMIT)
+        except Exception as e:
+            print(f"yield estimate failed for AOI {aoi_index}: {e}")
+            self.failed.add(aoi_index)
+            return self.mean_estimate()
+
+        self.estimates[aoi_index] = estimate
+        self._save_estimate(aoi_index, estimate)
+        return estimate
+
+    def remaining(self, chip_metadata_df):
+        """Chips still needed per class given the chips produced so far"""
+        produced = chip_metadata_df[chip_metadata_df['status'] == 'success']['lulc'].value_counts()
+        return {c: max(0, target - int(produced.get(c, 0))) for c, target in self.targets.items()}
+
+    def score(self, estimate, remaining):
+        """Expected number of chips an AOI contributes towards classes which are below target"""
+        return sum(min(estimate.get(c, 0), needed) for c, needed in remaining.items())
+
+    def next_aoi(self, aoi_gdf, remaining):
+        """
+        Pick the pending AOI with the largest expected contribution, then AOIs whose estimate
+        failed while classes are below target, None if no AOI contributes
+        """
+        best_index, best_score = None, 0
+        for aoi_index, aoi in aoi_gdf.iterrows():
+            estimate = self.estimate(aoi_index, aoi)
+            if aoi_index in self.failed:
+                continue
+            score = self.score(estimate, remaining)
+            if score > best_score:
+                best_index, best_score = aoi_index, score
+        if best_index is None and any(remaining.values()):
+            best_index = next((aoi_index for aoi_index in aoi_gdf.index if aoi_index in self.failed), None)
+        return best_index
+
+    def order(self, aoi_gdf, remaining):
+        """
+        Greedy processing order assuming AOIs yield their estimates. Returns the ordered AOI
+        indices, the indices of AOIs which are not expected to contribute to any target, and the
+        indices of AOIs whose estimate failed, which are ordered last.
+        """
+        remaining = dict(remaining)
+        pending = aoi_gdf
+        ordered = []
+        while len(pending):
+            aoi_index = self.next_aoi(pending, remaining)
+            if aoi_index is None:
+                break
+            ordered.append(aoi_index)
+            estimate = self.estimates.get(aoi_index) or self.mean_estimate()
+            remaining = {c: max(0, needed - estimate.get(c, 0)) for c, needed in remaining.items()}
+            pending = pending.drop(aoi_index)
+        return ordered, list(pending.index), [aoi_index for aoi_index in ordered if aoi_index in self.failed]
@@ -0,0 +1,102 @@
+from collections import Counter
+import time
+
+from src.utils.events import read_events
+
+
+class RunStatus:
+    """Aggregates the event stream of a run into progress and throughput figures."""
+    def __init__(self, events_path):
+        self.events_path = events_path
+        self.offset = 0
+        self.total_aois = 0
+        # AOIs done before the run started, and AOIs finished by any worker of the run
+        self.done_aois = 0
+        self.finished_aois = set()
+        # workers running now, throughput is measured from the start of the first of them so the
+        # time between resumes is excluded
+        self.active_workers = set()
+        self.run_start_time = None
+        self.run_finished_aois = set()
+        self.run_chips = 0
+        self.aoi_statuses = Counter()
+        self.chips = 0
+        self.bytes_written = 0
+        self.class_counts = Counter()
+        self.failures = Counter()
+        self.aoi_failures = Counter()
+        self.first_time = None
+        self.last_time = None
+        self.events_seen = 0
+
+    def refresh(self):
+        """Consume events appended since the last refresh"""
+        events, self.offset = read_events(self.events_path, self.offset)
+        for event in events:
+            self.update(event)
+
+    def update(self, event):
+        self.events_seen += 1
+        self.first_time = self.first_time or event["time"]
+        self.last_time = event["time"]
+        kind = event["event"]
+        if kind == "run_start":
+            total_aois = event.get("total_aois", event["aois"])
+            remaining = self.total_aois - self.done_aois - len(self.finished_aois)
+            if total_aois != self.total_aois or event["aois"] > remaining:
+                # a worker finding more AOIs to process than are left starts a new run, workers
+                # joining the run or resuming it find the AOIs finished so far done
+                self.total_aois = total_aois
+                self.done_aois = total_aois - event["aois"]
+                self.finished_aois = set()
+                self.active_workers = set()
+            # a worker starting again is no longer running its previous start
+            self.active_workers.discard(event["worker"])
+            if not self.active_workers:
+                self.run_start_time = event["time"]
+                self.run_finished_aois = set()
+                self.run_chips = 0
+            self.active_workers.add(event["worker"])
+        elif kind == "run_finish":
+            self.active_workers.discard(event["worker"])
+        elif kind == "aoi_finish":
+            self.finished_aois.add(event["aoi_index"])
+            self.run_finished_aois.add(event["aoi_index"])
+            if event["status"] == "success":
+                self.aoi_statuses["success"] += 1
+            else:
+                self.aoi_statuses["failed"] += 1
+                self.aoi_failures[event["status"]] += 1
+        elif kind == "chip_written":
+            self.chips += 1
+            self.run_chips += 1
+            self.bytes_written += event.get("bytes", 0)
+            self.class_counts[event["lulc"]] += 1
+        elif kind == "chip_failed":
+            self.failures[event["reason"]] += 1
+
+    def report(self):
+        """Human readable summary of the run so far"""
+        if not self.events_seen:
+            return f"no events in {self.events_path}"
+        # throughput since the running workers started
+        run_start_time = self.first_time if self.run_start_time is None else self.run_start_time
+        run_hours = max(self.last_time - run_start_time, 1) / 3600
+        total_aois = self.total_aois
+        finished = min(self.done_aois + len(self.finished_aois), total_aois)
+        lines = [
+            f"last event: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.last_time))}",
+            f"AOIs: {finished}/{total_aois} processed ({self.aoi_statuses['success']} success, {self.aoi_statuses['failed']} failed)",
+            f"chips: {self.chips} written, {self.bytes_written / 1e9:.2f} GB, {self.run_chips / run_hours:.1f} chips/hour",
+        ]
+        if self.run_finished_aois and total_aois > finished:
+            eta_hours = (total_aois - finished) * run_hours / len(self.run_finished_aois)
+            lines.append(f"ETA: {eta_hours:.1f} hours")
+        lines.append("chips by class: " + ", ".join(f"{lulc}: {n}" for lulc, n in sorted(self.class_counts.items())))
+        if self.aoi_failures:
+            lines.append("AOI failures by reason:")
+            lines += [f"  {reason}: {n}" for reason, n in self.aoi_failures.most_common()]
+        if self.failures:
+            lines.append("chip failures by reason:")
+            lines += [f"  {reason}: {n}" for reason, n in self.failures.most_common()]
+        return "\n".join(lines)
@@ -14,18 +14,24 @@ def process_array(
             fill_na: bool = False,
             na_value: int = -999,
             dtype = float,
+            offset: tuple[int, int] = (0, 0),
             ):
+    """
+    Extract the chip at sample block coords from a stack. offset is the (x, y) pixel index of the
+    first pixel of stack, for stacks which are a window of the full AOI stack.
+    """
 
     x, y = coords
+    x_offset, y_offset = offset
     # get dimensions of chip in pixels
     sample_size = int(sample_size / resolution)
     chip_size = int(chip_size / resolution)
     
     # get indices of stack for the area of the chip
-    min_x_index = (x) * sample_size - int((chip_size - sample_size)/2)
-    max_x_index = (x + 1) * sample_size + int((chip_size - sample_size)/2)
-    min_y_index = (y) * sample_size - int((chip_size - sample_size)/2)
-    max_y_index = (y + 1) * sample_size + int((chip_size - sample_size)/2)
+    min_x_index = (x) * sample_size - int((chip_size - sample_size)/2) - x_offset
+    max_x_index = (x + 1) * sample_size + int((chip_size - sample_size)/2) - x_offset
+    min_y_index = (y) * sample_size - int((chip_size - sample_size)/2) - y_offset
+    max_y_index = (y + 1) * sample_size + int((chip_size - sample_size)/2) - y_offset
     x_indices = slice(min_x_index, max_x_index)
     y_indices = slice(min_y_index, max_y_index)    
 
@@ -35,11 +41,13 @@ def process_array(
     # write the crs
     array.rio.write_crs(f"epsg:{epsg}", inplace=True)
     
-    # get values from the valid sample area 
-    array = array.where((array.x >= stack.x[(x) * sample_size]) &
-                              (array.x < stack.x[(x + 1) * sample_size]) & 
-                              (array.y <= stack.y[(y) * sample_size]) &
-                              (array.y > stack.y[(y + 1) * sample_size])
+    # get values from the valid sample area, stacks use na_value as their nodata sentinel. The sample
+    # area is selected by its coordinates, so blocks in the last row or column of a stack or window
+    # never index past its end
+    sample_x = stack.x.values[x * sample_size - x_offset:(x + 1) * sample_size - x_offset]
+    sample_y = stack.y.values[y * sample_size - y_offset:(y + 1) * sample_size - y_offset]
+    array = array.where(array.x.isin(sample_x) & array.y.isin(sample_y),
+                        na_value,
                              )
 
     # fill na values
@@ -51,8 +59,8 @@ def process_array(
     array = array.astype(np.dtype(dtype))
     array = array.rename(array_name)
     
-    # raise an exception if any values are missing
-    if missing_values(array, chip_size, sample_size):
+    # raise an exception if any values are missing, nodata counts as missing unless it is filled
+    if missing_values(array, chip_size, sample_size, nodata=None if fill_na else na_value):
         raise ValueError(f"{array_name} missing values")
     
     # Create a GeoSeries from the array's bounding box with its native CRS
@@ -63,12 +71,14 @@ def process_array(
     
     return array, footprint.wkt
 
-def missing_values(array, chip_size, sample_size):
-    """Check if the given S2/LC stacked array contains NaN values over the central sample area."""
+def missing_values(array, chip_size, sample_size, nodata=None):
+    """Check if the given S2/LC stacked array contains NaN or nodata values over the central sample area."""
     array_trimmed = array.isel(x = slice(int((chip_size - sample_size) / 2), int((chip_size + sample_size) / 2)), 
                                y = slice(int((chip_size - sample_size) / 2), int((chip_size + sample_size) / 2))
                               )
     has_nan = array_trimmed.isnull().any().item()
+    if nodata is not None:
+        has_nan = has_nan or (array_trimmed == nodata).any().item()
     
     # Calculate the number of zero pixels and the total number of pixels
     zero_pixels = (array_trimmed == 0).sum().item()
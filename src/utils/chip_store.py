@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import uuid
+
+# bump when the files written for a chip change, so old entries are never reused
+STORE_FORMAT = 1
+
+
+def link_or_copy(src, dst):
+    """Hard link src to dst, copying when the two are on different file systems"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class ChipStore:
+    """
+    Content addressed store of chip files shared by dataset versions. Entries are keyed by a hash of
+    everything that determines the files of a chip, and hold the files with the chip index removed
+    from their names together with the dates saved per platform.
+    """
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(**inputs):
+        payload = json.dumps({"format": STORE_FORMAT, **inputs}, sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def entry_path(self, key):
+        return self.directory / key[:2] / key
+
+    def contains(self, key):
+        return (self.entry_path(key) / "chip.json").exists()
+
+    def get(self, key, index, working_directory):
+        """Link the files of a stored chip into the working directory as chip index. Returns its dates"""
+        entry = self.entry_path(key)
+        with open(entry / "chip.json") as f:
+            manifest = json.load(f)
+        for name in manifest["files"]:
+            dst = Path(working_directory) / name.replace("_chip", f"_{index:06}", 1)
+            if dst.exists():
+                dst.unlink()
+            link_or_copy(entry / name, dst)
+        return manifest["dates"]
+
+    def put(self, key, index, paths, dates):
+        """Store the files written for chip index, unless another worker stored the same chip first"""
+        entry = self.entry_path(key)
+        if self.contains(key):
+            return
+        tmp_entry = entry.with_name(f"{key}.{uuid.uuid4().hex}.tmp")
+        tmp_entry.mkdir(parents=True)
+        names = []
+        for path in paths:
+            name = Path(path).name.replace(f"_{index:06}", "_chip", 1)
+            link_or_copy(path, tmp_entry / name)
+            names.append(name)
+        with open(tmp_entry / "chip.json", "w") as f:
+            json.dump({"files": names, "dates": dates}, f)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # the same chip was stored meanwhile
+            shutil.rmtree(tmp_entry, ignore_errors=True)
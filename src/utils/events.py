@@ -0,0 +1,41 @@
+import json
+import os
+from pathlib import Path
+import socket
+import threading
+import time
+
+
+class EventLog:
+    """
+    Append-only JSON lines stream of pipeline progress events. Each event records its type,
+    a unix timestamp and the worker which produced it, plus event specific fields.
+    """
+    def __init__(self, path, worker_id=None):
+        self.path = Path(path)
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self._lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        """Append one event, written as a single line so concurrent readers never see partial events"""
+        record = {"event": event, "time": time.time(), "worker": self.worker_id, **fields}
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock, open(self.path, "a") as f:
+            f.write(line)
+
+
+def read_events(path, offset=0):
+    """
+    Read events appended to an event log after byte offset. Returns the events and the offset
+    of the end of the last complete line, so callers can tail the log.
+    """
+    path = Path(path)
+    if not path.exists():
+        return [], offset
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    # ignore a trailing partial line which is still being written
+    complete = data[:data.rfind(b"\n") + 1]
+    events = [json.loads(line) for line in complete.decode().splitlines() if line.strip()]
+    return events, offset + len(complete)
@@ -0,0 +1,90 @@
+from collections import defaultdict
+import math
+from pathlib import Path
+import threading
+
+from shapely import wkt
+
+
+class FootprintIndex:
+    """
+    Grid hash over the footprints of accepted chips, used to reject chips which duplicate
+    an already accepted chip. Footprints are appended to a tab-separated file so resumed
+    runs and other workers sharing the working directory use the same index. Without a path
+    the index is kept in memory only. Refreshes and additions are safe across threads.
+    """
+    def __init__(self, path=None, overlap_threshold=0.5, cell_size=0.05):
+        self.path = Path(path) if path is not None else None
+        self.overlap_threshold = overlap_threshold
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+        self.footprints = {}
+        self._offset = 0
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def __len__(self):
+        return len(self.footprints)
+
+    def __contains__(self, chip_index):
+        return int(chip_index) in self.footprints
+
+    def _cells(self, footprint):
+        minx, miny, maxx, maxy = footprint.bounds
+        for i in range(math.floor(minx / self.cell_size), math.floor(maxx / self.cell_size) + 1):
+            for j in range(math.floor(miny / self.cell_size), math.floor(maxy / self.cell_size) + 1):
+                yield i, j
+
+    def _insert(self, chip_index, footprint):
+        if chip_index in self.footprints:
+            return
+        self.footprints[chip_index] = footprint
+        for cell in self._cells(footprint):
+            self.cells[cell].append(footprint)
+
+    def refresh(self):
+        """Load footprints appended to the index file since the last refresh."""
+        if self.path is None or not self.path.exists():
+            return
+        with self._lock:
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+            # ignore a trailing partial line which another worker may still be writing
+            complete = data[:data.rfind(b'\n') + 1]
+            self._offset += len(complete)
+            for line in complete.decode().splitlines():
+                chip_index, footprint = line.split('\t')
+                self._insert(int(chip_index), wkt.loads(footprint))
+
+    def is_duplicate(self, footprint):
+        """True if the footprint overlaps an accepted footprint by more than overlap_threshold of either area."""
+        footprint = wkt.loads(footprint) if isinstance(footprint, str) else footprint
+        for cell in self._cells(footprint):
+            for other in self.cells.get(cell, []):
+                if not footprint.intersects(other):
+                    continue
+                overlap = footprint.intersection(other).area
+                if overlap >= self.overlap_threshold * min(footprint.area, other.area):
+                    return True
+        return False
+
+    def add(self, chip_index, footprint):
+        """Add an accepted chip footprint to the index and append it to the index file."""
+        self.extend({chip_index: footprint})
+
+    def extend(self, footprints):
+        """
+        Add accepted chip footprints, a mapping of chip index to footprint, to the index and
+        append them to the index file in a single write.
+        """
+        footprints = {
+            int(chip_index): wkt.loads(footprint) if isinstance(footprint, str) else footprint
+            for chip_index, footprint in footprints.items()
+        }
+        with self._lock:
+            if self.path is not None and footprints:
+                with open(self.path, 'a') as f:
+                    f.write("".join(f"{chip_index}\t{footprint.wkt}\n" for chip_index, footprint in footprints.items()))
+            for chip_index, footprint in footprints.items():
+                self._insert(chip_index, footprint)
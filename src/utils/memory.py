@@ -0,0 +1,45 @@
+from contextlib import contextmanager
+import math
+import threading
+
+import numpy as np
+
+
+def estimate_stack_nbytes(bounds, resolution, n_bands, n_times, dtype):
+    """Estimates the in-memory size of a computed (time, band, y, x) stack covering projected bounds."""
+    minx, miny, maxx, maxy = bounds
+    width = math.ceil((maxx - minx) / resolution)
+    height = math.ceil((maxy - miny) / resolution)
+    return width * height * n_bands * n_times * np.dtype(dtype).itemsize
+
+
+class MemoryBudget:
+    """
+    Admission control for computed stacks. Callers reserve the estimated size of what they are about
+    to compute, and wait while the reservations of other computations would exceed the budget. One AOI
+    is split into strips which fit the budget on its own, so reservations only wait on each other when
+    a worker processes several AOIs at once (queue.threads).
+    """
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def fits(self, nbytes):
+        """True if nbytes could ever be admitted under the budget."""
+        return nbytes <= self.budget_bytes
+
+    @contextmanager
+    def reserve(self, nbytes):
+        """Block until nbytes fit under the budget, and hold them for the duration of the context."""
+        if not self.fits(nbytes):
+            raise ValueError("memory budget exceeded")
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight + nbytes <= self.budget_bytes)
+            self.in_flight += nbytes
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= nbytes
+                self._condition.notify_all()
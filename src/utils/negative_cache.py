@@ -0,0 +1,92 @@
+import hashlib
+import json
+from pathlib import Path
+import sqlite3
+import time
+
+import shapely
+
+# config parameters deciding each search stage, in the order the stages run
+SEARCH_STAGES = [
+    ("s2l2a", ["collection", "time_ranges", "cloud_cover", "nodata_pixel_percentage"]),
+    ("s1rtc", ["collection", "delta_days", "nodata_pixel_percentage"]),
+    ("lc2l2", ["collection", "platforms", "cloud_cover", "delta_days"]),
+    ("lulc", ["collection", "year"]),
+    ("dem", ["collection", "year"]),
+]
+# deterministic AOI failures and the number of search stages which decide them, s1rtc and lc2l2
+# scenes are searched together so either failure depends on both
+REASON_STAGES = {
+    "s2l2a scenes missing": 1,
+    "s1rtc scenes missing": 3,
+    "lc2l2 scenes missing": 3,
+    "lulc data missing": 4,
+    "dem data missing": 5,
+    "no candidate windows": 5,
+}
+# candidate windows also depend on the land cover read and the sampling grid
+CANDIDATE_PARAMS = [("lulc", ["resolution", "composite", "na_value"]), ("chips", ["sample_size"])]
+
+
+class NegativeResultCache:
+    """
+    SQLite cache of deterministic AOI failures shared by dataset versions. Failures are keyed by the
+    AOI geometry and the config parameters which decide them, so an AOI is only skipped while those
+    parameters are unchanged. With force, cached failures are ignored but new ones are still recorded.
+    """
+    def __init__(self, path, config, force=False):
+        self.path = Path(path)
+        self.config = config
+        self.force = force
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS failures (
+                    key TEXT PRIMARY KEY,
+                    reason TEXT NOT NULL,
+                    aoi_index INTEGER,
+                    version TEXT,
+                    recorded REAL NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=120)
+
+    def params(self, reason):
+        """Config parameters deciding a failure reason"""
+        stages = SEARCH_STAGES[:REASON_STAGES[reason]]
+        if reason == "no candidate windows":
+            stages = stages + CANDIDATE_PARAMS
+        return {
+            f"{section}.{name}": getattr(getattr(self.config, section), name, None)
+            for section, names in stages for name in names
+        }
+
+    def key(self, geometry, reason):
+        payload = json.dumps(
+            {"geometry": shapely.normalize(geometry).wkb_hex, "reason": reason, "params": self.params(reason)},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def lookup(self, geometry):
+        """The cached failure reason of an AOI under the current config, or None"""
+        if self.force:
+            return None
+        keys = [self.key(geometry, reason) for reason in REASON_STAGES]
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT reason FROM failures WHERE key IN ({','.join('?' * len(keys))}) LIMIT 1", keys
+            ).fetchone()
+        return row[0] if row else None
+
+    def record(self, aoi_index, geometry, reason):
+        """Cache the failure of an AOI if its reason is deterministic"""
+        if reason not in REASON_STAGES:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?)",
+                (self.key(geometry, reason), reason, int(aoi_index), self.config.dataset.version, time.time()),
+            )
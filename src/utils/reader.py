@@ -0,0 +1,65 @@
+import json
+import time
+
+from rasterio import windows
+from stackstac.rio_reader import AutoParallelRioReader, nodata_for_window
+
+from .tokens import TokenManager
+
+
+class AssetReader(AutoParallelRioReader):
+    """
+    stackstac reader which signs its asset href right before the dataset is opened, and retries
+    failed window reads with exponential backoff, reopening the dataset with a freshly signed href.
+    Windows which still fail are filled with nodata and appended to a JSON lines error log with
+    their bounds, so only the chips overlapping them are rejected.
+    """
+    def __init__(self, *, token_manager: TokenManager, retries=3, retry_delay=1.0, error_log=None, context=None, **kwargs):
+        super().__init__(**kwargs)
+        self.token_manager = token_manager
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.error_log = error_log
+        self.context = context or {}
+
+    def _open(self):
+        self.url = self.token_manager.sign(self.url)
+        return super()._open()
+
+    def read(self, window, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                return super().read(window, **kwargs)
+            except Exception as e:
+                error = e
+                # drop the dataset, it is reopened and re-signed on the next attempt
+                self.close()
+                if attempt < self.retries:
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        self.log_error(window, error)
+        return nodata_for_window(window, self.fill_value, self.dtype)
+
+    def log_error(self, window, error):
+        print(f"giving up reading {window} from {self.url.split('?')[0]}: {error!r}")
+        if self.error_log is None:
+            raise error
+        record = {
+            **self.context,
+            "url": self.url.split('?')[0],
+            "bounds": list(windows.bounds(window, self.spec.transform)),
+            "epsg": self.spec.epsg,
+            "error": repr(error),
+        }
+        # a single short write per line, appends from concurrent workers do not interleave
+        with open(self.error_log, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def __getstate__(self):
+        return {
+            **super().__getstate__(),
+            "token_manager": self.token_manager,
+            "retries": self.retries,
+            "retry_delay": self.retry_delay,
+            "error_log": self.error_log,
+            "context": self.context,
+        }
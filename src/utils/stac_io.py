@@ -0,0 +1,51 @@
+import threading
+import time
+
+from pystac_client.stac_api_io import StacApiIO
+from requests.adapters import HTTPAdapter
+
+
+class RateLimiter:
+    """Token bucket allowing on average `rate` calls per second, with bursts of up to `burst` calls."""
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call is allowed"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class PooledStacApiIO(StacApiIO):
+    """
+    StacApiIO sharing one pool of keep-alive connections between threads, so concurrent searches
+    reuse connections, with an optional rate limit on the requests sent to the STAC API.
+    """
+    def __init__(self, max_retries=None, pool_maxsize=10, rate_limiter=None, **kwargs):
+        super().__init__(max_retries=max_retries, **kwargs)
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize, max_retries=max_retries or 0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.rate_limiter = rate_limiter
+        # number of requests sent, used to size runs
+        self.request_count = 0
+        self._count_lock = threading.Lock()
+
+    def request(self, *args, **kwargs):
+        with self._count_lock:
+            self.request_count += 1
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return super().request(*args, **kwargs)
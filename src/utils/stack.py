@@ -1,9 +1,14 @@
 import stackstac
+from stackstac.rio_reader import AutoParallelRioReader
 import numpy as np
 import xarray as xr
 import geopandas as gpd
 from shapely.geometry import shape
 import pdb
+from dataclasses import replace
+from functools import partial
+from .tokens import TokenManager
+from .reader import AssetReader
 
 def pystac_itemcollection_to_gdf(item_collection):
     geometries = []
@@ -21,6 +26,70 @@ def pystac_itemcollection_to_gdf(item_collection):
     
     return gdf
 
+# named GDAL/HTTP profiles for comparing read throughput, their settings replace those of the io
+# section, "stackstac" reads with the stackstac default environment only
+IO_PROFILES = {
+    "configured": {},
+    "http1": {"http_multiplex": False},
+    "no_range_merge": {"merge_consecutive_ranges": False},
+    "small_cache": {"gdal_cachemax": 64, "vsi_curl_cache_size": 16_000_000},
+    "large_cache": {"gdal_cachemax": 2048, "vsi_curl_cache_size": 1_000_000_000},
+    "stackstac": None,
+}
+
+def build_gdal_env(io_config):
+    """Builds the stackstac GDAL environment from the `io` section of the config and its profile."""
+    if io_config.profile not in IO_PROFILES:
+        raise ValueError(f"unknown io profile: {io_config.profile}")
+    if IO_PROFILES[io_config.profile] is None:
+        return stackstac.DEFAULT_GDAL_ENV
+    io_config = replace(io_config, **IO_PROFILES[io_config.profile])
+    return stackstac.DEFAULT_GDAL_ENV.updated(
+        always=dict(
+            GDAL_CACHEMAX=io_config.gdal_cachemax,
+            CPL_VSIL_CURL_CACHE_SIZE=io_config.vsi_curl_cache_size,
+            GDAL_HTTP_VERSION="2" if io_config.http_multiplex else "1.1",
+            GDAL_HTTP_MULTIPLEX="YES" if io_config.http_multiplex else "NO",
+            GDAL_HTTP_MERGE_CONSECUTIVE_RANGES="YES" if io_config.merge_consecutive_ranges else "NO",
+            GDAL_HTTP_TIMEOUT=io_config.http_timeout,
+            GDAL_HTTP_CONNECTTIMEOUT=io_config.http_connect_timeout,
+            GDAL_HTTP_MAX_RETRY=io_config.http_max_retry,
+            GDAL_HTTP_RETRY_DELAY=io_config.http_retry_delay,
+        ),
+        open=dict(
+            GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR" if io_config.disable_read_dir_on_open else "FALSE",
+        ),
+    )
+
+def build_reader(io_config, error_log=None, context=None):
+    """
+    Builds the stackstac reader, which signs asset hrefs with cached SAS tokens right before reading
+    and retries failed reads. Without an error log, reads which still fail raise; with one, they are
+    logged together with context and read as nodata.
+    """
+    token_manager = TokenManager(io_config.signer, io_config.token_refresh_seconds)
+    return partial(
+        AssetReader,
+        token_manager=token_manager,
+        retries=io_config.read_retries,
+        retry_delay=io_config.read_retry_delay,
+        error_log=str(error_log) if error_log else None,
+        context=context,
+    )
+
+def chip_aligned_chunksize(resolution, sample_size, n_times, n_bands, dtype, cog_block_size=1024, chunk_bytes=128_000_000, time_chunk=-1):
+    """
+    Computes a (time, band, y, x) chunksize which holds every band and time_chunk time steps (all by
+    default), with a spatial edge that is a multiple of the sample window, close to the COG block
+    size and within chunk_bytes.
+    """
+    sample_pixels = max(1, int(sample_size / resolution))
+    chunk_times = n_times if time_chunk == -1 else time_chunk
+    max_edge = int(np.sqrt(chunk_bytes / (chunk_times * n_bands * np.dtype(dtype).itemsize)))
+    edge = min(cog_block_size, max_edge)
+    edge = max(sample_pixels, edge // sample_pixels * sample_pixels)
+    return (time_chunk, -1, edge, edge)
+
 def stack_data(
     items,
     platform,
@@ -31,6 +100,11 @@ def stack_data(
     epsg=None,
     bbox=None,
     bbox_is_latlon=True,
+    gdal_env=None,
+    chunksize=1024,
+    dtype=np.float64,
+    fill_value=np.nan,
+    reader=None,
 ):
 
     if bbox is None:
@@ -52,27 +126,29 @@ def stack_data(
         assets=bands,
         epsg=epsg,
         resolution=resolution,
-        fill_value=np.nan,
+        dtype=dtype,
+        fill_value=fill_value,
+        rescale=np.issubdtype(dtype, np.floating),
+        gdal_env=gdal_env,
+        chunksize=chunksize,
+        reader=reader or AutoParallelRioReader,
        **bounds_kwargs
     )
-    if platform in ['s2l2a', 'LC2L2']:
-        stack = mask_cloudy_pixels(stack, platform)
-
-    if platform not in ['s2l2a']:
-        quarter_times = stack.time.groupby("time.quarter").first()
-        stack = stack.groupby("time.quarter").first(skipna=True)
-        stack['quarter'] = quarter_times.values
-        stack = stack.rename({'quarter': 'time'})
- 
- 
     if len(stack.band) != len(bands):
         raise ValueError(f"{platform} unexpected number of bands")
-    if platform in ['s2l2a', 'LC2L2']:
-        stack = stack.drop_sel(band=cloud_band)
-    
+
+    # s2l2a has one scene per time range, other platforms are composited by quarter
+    stack = mask_and_composite(
+        stack,
+        platform,
+        cloud_band=cloud_band if platform in ['s2l2a', 'lc2l2'] else None,
+        composite=platform not in ['s2l2a'],
+        nodata=fill_value,
+    )
+ 
     return stack
 
-def stack_dem_data(items, native_crs, resolution, epsg=None, bbox=None, bbox_is_latlon=False):
+def stack_dem_data(items, native_crs, resolution, epsg=None, bbox=None, bbox_is_latlon=False, gdal_env=None, chunksize=1024, dtype=np.float64, fill_value=np.nan, composite="mosaic", reader=None):
     if not items:
         print("No dem data found.")
         return None
@@ -89,12 +165,19 @@ def stack_dem_data(items, native_crs, resolution, epsg=None, bbox=None, bbox_is_
         items,
         epsg=epsg,
         resolution=resolution,
+        dtype=dtype,
+        fill_value=fill_value,
+        rescale=np.issubdtype(dtype, np.floating),
+        gdal_env=gdal_env,
+        chunksize=chunksize,
+        reader=reader or AutoParallelRioReader,
        **bounds_kwargs
-    ).mean(dim="time").squeeze()
+    )
+    stack = composite_tiles(stack, composite, fill_value, dtype)
     
     return stack
 
-def stack_lulc_data(items, native_crs, resolution, epsg, bbox, bbox_is_latlon=False):
+def stack_lulc_data(items, native_crs, resolution, epsg, bbox, bbox_is_latlon=False, gdal_env=None, chunksize=1024, dtype=np.float64, fill_value=np.nan, composite="mosaic", reader=None):
     if not items:
         print("No Land Cover data found.")
         return None
@@ -111,10 +194,57 @@ def stack_lulc_data(items, native_crs, resolution, epsg, bbox, bbox_is_latlon=Fa
         items,
         epsg=epsg,
         resolution=resolution,
+        dtype=dtype,
+        fill_value=fill_value,
+        rescale=np.issubdtype(dtype, np.floating),
+        gdal_env=gdal_env,
+        chunksize=chunksize,
+        reader=reader or AutoParallelRioReader,
        **bounds_kwargs
-    ).mean(dim="time").squeeze()
+    )
+    stack = composite_tiles(stack, composite, fill_value, dtype)
     return stack
 
+def stack_coverage(items, platform, epsg, bounds, resolution, asset, cloud_band=None, time_reduction="all", gdal_env=None, reader=None):
+    """
+    Lazy 2D mask of pixels which are valid, non zero and clear in every time step ("all"), in
+    every quarter ("quarter") or in any tile ("any"), read from one asset at a coarse resolution
+    so GDAL reads COG overviews. With cloud_band the clear sky mask of that band is used.
+    """
+    stack = stackstac.stack(
+        items,
+        assets=[cloud_band or asset],
+        epsg=epsg,
+        resolution=resolution,
+        dtype="float64",
+        fill_value=np.nan,
+        rescale=False,
+        gdal_env=gdal_env,
+        reader=reader or AutoParallelRioReader,
+        bounds=bounds,
+    ).isel(band=0)
+    valid = is_valid(stack, np.nan) & (stack != 0)
+    if cloud_band:
+        clear = xr.apply_ufunc(
+            clear_sky_mask, stack.fillna(0), kwargs={"platform": platform}, dask="parallelized", output_dtypes=[bool]
+        )
+        valid &= clear
+    if time_reduction == "quarter":
+        return valid.groupby("time.quarter").any("time").all("quarter")
+    elif time_reduction == "any":
+        return valid.any("time")
+    return valid.all("time")
+
+def composite_tiles(stack, composite, fill_value, dtype):
+    """Flattens the tiles of an annual/static collection along time, by mosaic or by mean."""
+    if composite == "mosaic":
+        # first valid tile per pixel, in native dtype
+        return stackstac.mosaic(stack, dim="time", nodata=fill_value, reverse=True).squeeze()
+    elif composite == "mean":
+        stack = stack.where(is_valid(stack, fill_value)).mean(dim="time").squeeze()
+        return stack.fillna(fill_value).astype(dtype)
+    raise ValueError(f"unknown composite method: {composite}")
+
 def adjust_bbox_to_resolution(bbox, resolution):
     '''Adjusts bbox from rioxarray.rio output so stackstac snaps to grid correctly'''
     # this function gets the bbox which intersects the centers of all pixels we want from stackstac
@@ -123,25 +253,75 @@ def adjust_bbox_to_resolution(bbox, resolution):
     bbox_adjusted = (minx + r, miny, maxx, maxy - r)
     return bbox_adjusted
    
-def mask_cloudy_pixels(stack, platform):
+def is_valid(array, nodata):
+    """Returns a boolean array which is True where values are neither NaN nor the nodata sentinel."""
+    valid = array == array  # False for NaN
+    if not (isinstance(nodata, float) and np.isnan(nodata)):
+        valid &= array != nodata
+    return valid
+
+def clear_sky_mask(cloud, platform):
+    """Returns a boolean array which is True where the QA/SCL values of a platform are clear."""
     if platform == "lc2l2":
-        qa = stack.sel(band="qa_pixel").astype("uint16")
-        
-        # Define bitmask for cloud-related flags
+        # Define bitmask for cloud-related flags (dilated cloud, cirrus, cloud, cloud shadow)
         mask_bitfields = [1, 2, 3, 4]
         bitmask = sum(1 << b for b in mask_bitfields)
-        clear_mask = (qa & bitmask) == 0
-        
-        # Broadcast the clear_mask to match stack shape
-        clear_mask = clear_mask.broadcast_like(stack)
-        
-        # Apply the mask
-        stack = stack.where(clear_mask)
+        return (cloud.astype("uint16") & bitmask) == 0
     elif platform == "s2l2a":
-        scl = stack.sel(band="SCL")
-        clear_mask = scl.isin([2, 4, 5, 6, 11])
-        stack = stack.where(clear_mask)
+        return np.isin(cloud, [2, 4, 5, 6, 11])
+    raise ValueError(f"attempting to cloud mask invalid platform: {platform}")
+
+def _mask_composite_block(block, groups, n_groups, platform, cloud_index, keep_index, nodata):
+    """
+    Masks cloudy pixels and takes the first valid value of each group of time steps for one
+    (time, band, y, x) chunk holding every time step and band.
+    """
+    data = block[:, keep_index]
+    if cloud_index is not None:
+        cloud = block[:, cloud_index]
+        cloud_valid = is_valid(cloud, nodata)
+        clear = clear_sky_mask(np.where(cloud_valid, cloud, 0), platform) & cloud_valid
+    out = np.full((n_groups, len(keep_index)) + block.shape[2:], nodata, dtype=block.dtype)
+    for t, group in enumerate(groups):
+        values = data[t]
+        valid = is_valid(values, nodata)
+        if cloud_index is not None:
+            valid &= clear[t]
+        composite = out[group]
+        fill = valid & ~is_valid(composite, nodata)
+        composite[fill] = values[fill]
+    return out
+
+def mask_and_composite(stack, platform, cloud_band=None, composite=True, nodata=np.nan):
+    """
+    Cloud masks a stack and composites it to the first valid pixel of each quarter, in a single
+    blockwise pass over each chunk. Masked pixels are set to nodata and the cloud band is dropped.
+    """
+    if composite:
+        quarters = stack.time.dt.quarter.values
+        labels = np.unique(quarters)
+        groups = np.searchsorted(labels, quarters)
     else:
-        print(f"attempting to cloud mask invalid platform: {platform}")
-        return None
-    return stack
\ No newline at end of file
+        groups = np.arange(len(stack.time))
+    n_groups = groups.max() + 1
+    # each output time step takes its coordinates from the first scene of its group
+    first_indices = [int(np.flatnonzero(groups == group)[0]) for group in range(n_groups)]
+
+    bands = list(stack.band.values)
+    cloud_index = bands.index(cloud_band) if cloud_band else None
+    keep_index = [i for i, band in enumerate(bands) if band != cloud_band]
+
+    data = stack.data.rechunk({0: -1, 1: -1})
+    data = data.map_blocks(
+        _mask_composite_block,
+        groups=groups,
+        n_groups=n_groups,
+        platform=platform,
+        cloud_index=cloud_index,
+        keep_index=keep_index,
+        nodata=nodata,
+        chunks=((n_groups,), (len(keep_index),)) + data.chunks[2:],
+        dtype=data.dtype,
+    )
+    template = stack.isel(time=first_indices, band=keep_index)
+    return template.copy(data=data)
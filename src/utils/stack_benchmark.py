@@ -0,0 +1,237 @@
+"""
+Benchmarks of stack building and reading choices, on synthetic data by default, run as
+`python -m src.utils.stack_benchmark <name>`.
+"""
+from dataclasses import replace
+from datetime import datetime
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import dask
+import dask.array as da
+import numpy as np
+import pandas as pd
+import pystac
+import rasterio
+from rasterio.transform import from_origin
+import stackstac
+import xarray as xr
+
+from src.gelos_config import IOConfig
+from src.utils.stack import (
+    IO_PROFILES,
+    build_gdal_env,
+    chip_aligned_chunksize,
+    composite_tiles,
+    mask_and_composite,
+)
+
+
+def timed_compute(array):
+    """Compute a lazy array, returning wall seconds and the peak bytes allocated while computing"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    with dask.config.set(scheduler="threads"):
+        array.compute()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def synthetic_tiles(n_tiles=4, size=4096, chunk=1024, dtype="uint8", fill_value=0):
+    """
+    A (time, band, y, x) stack of an annual collection as stackstac builds it: one time step per
+    tile, each tile covering an overlapping vertical band of the AOI and fill_value elsewhere
+    """
+    rng = np.random.default_rng(0)
+    tile_width = size // n_tiles + chunk
+    tiles = []
+    for t in range(n_tiles):
+        left = min(t * (size // n_tiles), size - tile_width)
+        tile = np.full((1, 1, size, size), fill_value, dtype=dtype)
+        tile[..., left:left + tile_width] = rng.integers(1, 12, (size, tile_width), dtype=dtype)
+        tiles.append(da.from_array(tile, chunks=(1, 1, chunk, chunk)))
+    return xr.DataArray(da.concatenate(tiles, axis=0), dims=("time", "band", "y", "x"))
+
+
+def benchmark_composite(n_tiles=4, size=4096):
+    """Compare flattening land cover tiles by mosaic and by mean: tasks, time, peak memory and output bytes"""
+    results = []
+    for composite in ["mosaic", "mean"]:
+        stack = composite_tiles(synthetic_tiles(n_tiles, size), composite, 0, "uint8")
+        n_tasks = len(stack.__dask_graph__())
+        seconds, peak = timed_compute(stack)
+        results.append({
+            "composite": composite,
+            "tasks": n_tasks,
+            "compute_s": round(seconds, 2),
+            "peak_mb": round(peak / 1e6, 1),
+            "output_mb": round(stack.nbytes / 1e6, 1),
+        })
+    return pd.DataFrame(results)
+
+
+def synthetic_scenes(n_times=8, n_bands=5, size=2048, chunks=(1, 1, 1024, 1024)):
+    """
+    A float64 (time, band, y, x) Landsat-like stack of n_times scenes over four quarters, whose last
+    band is a QA band with random cloud bits, in stackstac's default chunks unless chunks is set
+    """
+    bands = [f"band{i}" for i in range(n_bands - 1)] + ["qa_pixel"]
+    data = da.random.default_rng(0).random((n_times, n_bands, size, size), chunks=chunks)
+    qa = da.floor(data[:, -1:] * 32)
+    data = da.concatenate([data[:, :-1], qa], axis=1).rechunk(chunks)
+    times = pd.date_range("2023-01-01", "2023-12-31", periods=n_times)
+    return xr.DataArray(data, dims=("time", "band", "y", "x"), coords={"time": times, "band": bands})
+
+
+def where_groupby_composite(stack, cloud_band):
+    """Cloud masking and quarterly compositing as stack_data did it before the blockwise kernel"""
+    bitmask = sum(1 << b for b in [1, 2, 3, 4])
+    clear = (stack.sel(band=cloud_band).astype("uint16") & bitmask) == 0
+    stack = stack.where(clear.broadcast_like(stack))
+    quarter_times = stack.time.groupby("time.quarter").first()
+    stack = stack.groupby("time.quarter").first(skipna=True)
+    stack["quarter"] = quarter_times.values
+    return stack.rename({"quarter": "time"}).drop_sel(band=cloud_band)
+
+
+def benchmark_graph(size=2048, sample_pixels=32):
+    """
+    Compare graph size, compute time and peak memory of cloud masking and quarterly compositing a
+    synthetic Landsat AOI: where + groupby in stackstac's default chunks, the blockwise kernel in
+    the same chunks, and the blockwise kernel in chunks aligned to the chip sampling grid
+    """
+    size = int(size)
+    n_times, n_bands = 8, 5
+    aligned = chip_aligned_chunksize(30, 30 * sample_pixels, n_times, n_bands, np.float64)
+    aligned = (n_times, n_bands) + aligned[2:]
+    variants = {
+        "where_groupby": lambda: where_groupby_composite(synthetic_scenes(size=size), "qa_pixel"),
+        "blockwise": lambda: mask_and_composite(synthetic_scenes(size=size), "lc2l2", "qa_pixel"),
+        "blockwise_aligned": lambda: mask_and_composite(synthetic_scenes(size=size, chunks=aligned), "lc2l2", "qa_pixel"),
+    }
+    results = []
+    for name, build in variants.items():
+        stack = build()
+        n_tasks = len(stack.__dask_graph__())
+        seconds, peak = timed_compute(stack)
+        results.append({
+            "variant": name,
+            "chunks": "x".join(str(c[0]) for c in stack.data.chunks),
+            "tasks": n_tasks,
+            "compute_s": round(seconds, 2),
+            "peak_mb": round(peak / 1e6, 1),
+        })
+    return pd.DataFrame(results)
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serves byte ranges of files with a fixed latency per request, counting requests"""
+    latency = 0.0
+    requests = 0
+
+    def do_GET(self):
+        type(self).requests += 1
+        time.sleep(self.latency)
+        path = self.translate_path(self.path)
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        if "Range" in self.headers:
+            start, end = self.headers["Range"].split("=")[1].split(",")[0].split("-")
+            start, end = int(start), min(int(end or size - 1), size - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            self.wfile.write(f.read(end - start + 1))
+
+    def log_message(self, *args):
+        pass
+
+
+def synthetic_cog(path, size=4096, block=512):
+    """Write a tiled, compressed uint16 GeoTIFF like a Sentinel-2 band, returning its bbox and proj properties"""
+    rng = np.random.default_rng(0)
+    transform = from_origin(500000, 4000000, 10, 10)
+    with rasterio.open(path, "w", driver="GTiff", width=size, height=size, count=1, dtype="uint16",
+                       crs="EPSG:32633", transform=transform, tiled=True, blockxsize=block,
+                       blockysize=block, compress="deflate") as dst:
+        dst.write(rng.integers(0, 10000, (1, size, size), dtype="uint16"))
+    bbox = [500000, 4000000 - 10 * size, 500000 + 10 * size, 4000000]
+    return bbox, {"proj:epsg": 32633, "proj:shape": [size, size], "proj:transform": list(transform)[:6]}
+
+
+def benchmark_io(href=None, latency=0.05, repeats=2):
+    """
+    Compare read throughput of the io profiles by stacking one COG band over its full extent.
+    Without href a synthetic COG is served from a local HTTP/1.1 server with latency seconds per
+    request, which shows the effect of range merging and caching but not of HTTP/2 multiplexing.
+    """
+    server = None
+    if not href:
+        directory = tempfile.mkdtemp()
+        bbox, proj = synthetic_cog(f"{directory}/band.tif")
+        RangeRequestHandler.latency = float(latency)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), partial(RangeRequestHandler, directory=directory))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        href = f"http://127.0.0.1:{server.server_port}/band.tif"
+    else:
+        with rasterio.open(href) as src:
+            bbox = list(src.bounds)
+            proj = {"proj:epsg": src.crs.to_epsg(), "proj:shape": [src.height, src.width],
+                    "proj:transform": list(src.transform)[:6]}
+
+    def read(profile, run):
+        # GDAL caches reads per href for the life of the process, local reads get their own href
+        item = pystac.Item("benchmark", None, bbox, datetime(2023, 1, 1), proj)
+        item.add_asset("band", pystac.Asset(f"{href}?run={run}" if server else href, media_type=pystac.MediaType.COG))
+        stack = stackstac.stack([item], assets=["band"], dtype="uint16", fill_value=np.uint16(0), rescale=False,
+                                chunksize=1024, gdal_env=build_gdal_env(replace(IOConfig(), profile=profile)))
+        start = time.perf_counter()
+        with dask.config.set(scheduler="threads", num_workers=8):
+            stack.compute()
+        return time.perf_counter() - start, stack.nbytes
+
+    # the first read also starts GDAL and the thread pool
+    read("configured", "warmup")
+    results = []
+    for profile in IO_PROFILES:
+        seconds = []
+        for repeat in range(int(repeats)):
+            RangeRequestHandler.requests = 0
+            elapsed, nbytes = read(profile, f"{profile}-{repeat}")
+            seconds.append(elapsed)
+        results.append({
+            "profile": profile,
+            "read_s": round(min(seconds), 2),
+            "mb_per_s": round(nbytes / 1e6 / min(seconds), 1),
+            "requests": RangeRequestHandler.requests if server else None,
+        })
+    if server:
+        server.shutdown()
+    return pd.DataFrame(results)
+
+
+BENCHMARKS = {
+    "composite": benchmark_composite,
+    "io": benchmark_io,
+    "graph": benchmark_graph,
+}
+
+if __name__ == '__main__':
+    # the benchmark name and its arguments, e.g. `io <href>` to read a remote COG, or every benchmark
+    for name in sys.argv[1:2] or BENCHMARKS:
+        print(f"{name}:")
+        print(BENCHMARKS[name](*sys.argv[2:]).to_string(index=False))
@@ -0,0 +1,152 @@
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import time
+import uuid
+
+import xarray as xr
+
+# bump when the layout of cached stacks changes, so old entries are never read
+CACHE_FORMAT = 2
+# temporary stores older than this are left over from crashed or failed writes
+STALE_SECONDS = 6 * 3600
+
+
+class StackCache:
+    """
+    Local cache of computed AOI stacks in chunked, compressed Zarr stores. Entries are keyed by the
+    scene ids and stacking parameters of a stack, and filled with the pixel rows computed for
+    chipping, so chips can be regenerated with different chip settings from local disk. The least
+    recently used entries are evicted above max_bytes when an AOI is done. Row sidecars are updated
+    and entries evicted under a lock on the cache directory, which workers may share.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    @contextmanager
+    def locked(self):
+        """Hold the exclusive lock of the cache directory"""
+        with open(self.directory / "cache.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def key(platform, scene_ids, **params):
+        """Hash of everything that determines the values of a computed stack"""
+        payload = json.dumps(
+            {"format": CACHE_FORMAT, "platform": platform, "scene_ids": sorted(scene_ids), **params},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def entry_path(self, key):
+        return self.directory / f"{key}.zarr"
+
+    def open(self, path, name):
+        """Lazily open a cached stack, reads only touch the chunks that are indexed"""
+        return xr.open_zarr(path, consolidated=False)["data"].rename(name)
+
+    def rows_path(self, key):
+        """Sidecar listing the [start, end) pixel row ranges written to an entry"""
+        return self.directory / f"{key}.rows.json"
+
+    def written_rows(self, key):
+        path = self.rows_path(key)
+        if not path.exists():
+            return []
+        with open(path) as f:
+            return json.load(f)
+
+    def window(self, key, name, start, end):
+        """Lazily read pixel rows [start, end) of a cached stack, or None unless all of them are cached"""
+        covered = start
+        for row_start, row_end in sorted(self.written_rows(key)):
+            if row_start <= covered:
+                covered = max(covered, row_end)
+        path = self.entry_path(key)
+        if covered < end or not path.exists():
+            return None
+        # the modification time of an entry records its last use, for eviction
+        os.utime(path)
+        print(f"reading {name} rows {start}-{end} from cache")
+        return self.open(path, name).isel(y=slice(start, end))
+
+    def write(self, key, stack, start, computed):
+        """
+        Write the computed pixel rows of a stack, starting at row start, to its cache entry. The entry
+        is created from the lazy stack with metadata and coordinates only, so rows are only ever
+        written once they have been computed for chipping.
+        """
+        path = self.entry_path(key)
+        if not path.exists():
+            tmp_path = self.directory / f"{key}.{uuid.uuid4().hex}.tmp"
+            self.dataset(stack).to_zarr(tmp_path, mode="w", compute=False, consolidated=False, zarr_format=2)
+            try:
+                os.replace(tmp_path, path)
+            except OSError:
+                # another worker created the same entry meanwhile
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+        end = start + computed.sizes["y"]
+        data = self.dataset(computed)
+        # variables without rows, such as the x and time coordinates, are already in the entry
+        data = data.drop_vars([name for name in data.variables if "y" not in data[name].dims])
+        start_time = time.perf_counter()
+        data.to_zarr(path, mode="r+", region={"y": slice(start, end)}, consolidated=False, zarr_format=2)
+        print(f"cached {stack.name} rows {start}-{end} in {time.perf_counter() - start_time:.1f}s")
+
+        with self.locked():
+            # an entry evicted while its rows were written is not listed
+            if not path.exists():
+                return
+            tmp_rows = self.rows_path(key).with_suffix(f".{uuid.uuid4().hex}.tmp")
+            with open(tmp_rows, "w") as f:
+                json.dump(self.written_rows(key) + [[start, end]], f)
+            os.replace(tmp_rows, self.rows_path(key))
+            # region writes do not touch the entry directory, which records its last use
+            os.utime(path)
+
+    @staticmethod
+    def dataset(stack):
+        # only dimension coordinates are needed to chip a stack
+        data = stack.reset_coords(drop=True).rename("data").to_dataset()
+        data.attrs = {}
+        data["data"].attrs = {}
+        return data
+
+    def size(self, path):
+        return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+    def evict(self):
+        """Remove stale temporary files and least recently used entries above max_bytes"""
+        with self.locked():
+            self._evict()
+
+    def _evict(self):
+        now = time.time()
+        for tmp_path in self.directory.glob("*.tmp"):
+            if now - tmp_path.stat().st_mtime > STALE_SECONDS:
+                if tmp_path.is_dir():
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+                else:
+                    tmp_path.unlink(missing_ok=True)
+
+        entries = sorted(self.directory.glob("*.zarr"), key=lambda path: path.stat().st_mtime)
+        sizes = {path: self.size(path) for path in entries}
+        total = sum(sizes.values())
+        for path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            self.rows_path(path.stem).unlink(missing_ok=True)
+            total -= sizes[path]
@@ -0,0 +1,106 @@
+import os
+from pathlib import Path
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+TABLE_EXTENSIONS = {
+    "geojson": ".geojson",
+    "parquet": ".parquet",
+    "flatgeobuf": ".fgb",
+}
+# comma-joined string columns, stored as list columns in GeoParquet
+LIST_COLUMN_SUFFIXES = ("_dates", "_scene_ids", "_thumbs", "_paths")
+# low cardinality columns, dictionary encoded in GeoParquet
+DICTIONARY_COLUMNS = ["lulc", "category", "color", "status"]
+
+
+def table_path(directory, stem, table_format):
+    if table_format not in TABLE_EXTENSIONS:
+        raise ValueError(f"unknown table format: {table_format}")
+    return Path(directory) / f"{stem}{TABLE_EXTENSIONS[table_format]}"
+
+
+def is_list_column(column):
+    return column.endswith(LIST_COLUMN_SUFFIXES)
+
+
+def to_columnar(gdf):
+    """Split comma-joined columns into lists and dictionary encode low cardinality columns"""
+    gdf = gdf.copy()
+    for column in gdf.columns:
+        if is_list_column(column):
+            gdf[column] = gdf[column].map(lambda value: value.split(",") if isinstance(value, str) and value else [])
+        elif column in DICTIONARY_COLUMNS:
+            gdf[column] = gdf[column].astype("category")
+    return gdf
+
+
+def from_columnar(gdf):
+    """Join list columns back into the comma-joined strings used by the pipeline"""
+    gdf = gdf.copy()
+    for column in gdf.columns:
+        if is_list_column(column):
+            gdf[column] = gdf[column].map(lambda value: ",".join(value) if value is not None else None)
+        elif isinstance(gdf[column].dtype, pd.CategoricalDtype):
+            gdf[column] = gdf[column].astype(object).where(gdf[column].notna(), None)
+    return gdf
+
+
+def write_table(gdf, directory, stem, formats):
+    """Write a GeoDataFrame in every requested format, replacing each file atomically"""
+    for table_format in formats:
+        path = table_path(directory, stem, table_format)
+        tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp{path.suffix}")
+        if table_format == "parquet":
+            to_columnar(gdf).to_parquet(tmp_path, index=False)
+        elif table_format == "flatgeobuf":
+            gdf.to_file(tmp_path, driver="FlatGeobuf", SPATIAL_INDEX="YES", index=False)
+        else:
+            gdf.to_file(tmp_path, driver="GeoJSON", index=False)
+        os.replace(tmp_path, path)
+
+
+def read_table(directory, stem, formats):
+    """Read a table from its primary (first) format, with comma-joined string columns"""
+    if formats[0] == "flatgeobuf":
+        # the spatial index of a FlatGeobuf file reorders its rows, so it is written as an export only
+        raise ValueError("flatgeobuf cannot be the primary table format, list geojson or parquet first")
+    path = table_path(directory, stem, formats[0])
+    if formats[0] == "parquet":
+        return from_columnar(gpd.read_parquet(path))
+    return gpd.read_file(path)
+
+
+def benchmark(n_rows=500_000, directory="/tmp/table_benchmark"):
+    """Time writing and reading a synthetic chip tracker of n_rows in every table format"""
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(0)
+    lon, lat = rng.uniform(-180, 180, n_rows), rng.uniform(-60, 70, n_rows)
+    dates = "20230115,20230415,20230715,20231015"
+    gdf = gpd.GeoDataFrame({
+        "id": np.arange(n_rows),
+        "lulc": rng.choice(["1", "2", "5", "7", "8", "11"], n_rows),
+        "category": rng.choice(["Water", "Trees", "Crops", "Built area", "Bare ground", "Rangeland"], n_rows),
+        "status": "success",
+        "s2l2a_dates": dates,
+        "s2l2a_paths": [",".join(f"s2l2a_{i:06}_{d}.tif" for d in dates.split(",")) for i in range(n_rows)],
+    }, geometry=gpd.points_from_xy(lon, lat).buffer(0.005, cap_style=3), crs=4326)
+
+    results = []
+    for table_format in TABLE_EXTENSIONS:
+        start = time.perf_counter()
+        write_table(gdf, directory, "benchmark", [table_format])
+        write_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        read_table(directory, "benchmark", [table_format])
+        read_seconds = time.perf_counter() - start
+        size_mb = table_path(directory, "benchmark", table_format).stat().st_size / 1e6
+        results.append({"format": table_format, "write_s": round(write_seconds, 1), "read_s": round(read_seconds, 1), "size_mb": round(size_mb, 1)})
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    print(benchmark().to_string(index=False))
@@ -0,0 +1,48 @@
+import threading
+from urllib.parse import urlparse
+
+import planetary_computer
+
+BLOB_STORAGE_DOMAIN = ".blob.core.windows.net"
+
+# tokens are cached per process, so every dask worker requests one token per storage container
+_tokens = {}
+_tokens_lock = threading.Lock()
+
+
+class TokenManager:
+    """
+    Signs Azure blob hrefs with one cached SAS token per storage account and container, requesting
+    a new token when the cached one is within refresh_seconds of expiring. With signer "none" hrefs
+    are returned unchanged, for offline runs against local or public data.
+    """
+    def __init__(self, signer="planetary_computer", refresh_seconds=600):
+        if signer not in ("planetary_computer", "none"):
+            raise ValueError(f"unknown signer: {signer}")
+        self.signer = signer
+        self.refresh_seconds = refresh_seconds
+
+    def token(self, account_name, container_name):
+        """Cached SAS token for a container, refreshed before it expires"""
+        key = (account_name, container_name)
+        with _tokens_lock:
+            token = _tokens.get(key)
+            if token is None or token.ttl() < self.refresh_seconds:
+                # planetary_computer keeps its own cache until a minute before expiry, drop it to get a fresh token
+                settings = planetary_computer.settings.Settings.get()
+                planetary_computer.sas.TOKEN_CACHE.pop(f"{settings.sas_url}/{account_name}/{container_name}", None)
+                token = planetary_computer.sas.get_token(account_name, container_name)
+                _tokens[key] = token
+        return token
+
+    def sign(self, href):
+        """Sign an href with the current token of its container, replacing any previous signature"""
+        if self.signer == "none":
+            return href
+        parsed = urlparse(href)
+        if not parsed.netloc.endswith(BLOB_STORAGE_DOMAIN):
+            return href
+        account_name, container_name = planetary_computer.sas.parse_blob_url(parsed)
+        unsigned = parsed._replace(query="").geturl()
+        return f"{unsigned}?{self.token(account_name, container_name).token}"
+
@@ -0,0 +1,190 @@
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import socket
+import sqlite3
+import threading
+import time
+
+
+class AOIWorkQueue:
+    """
+    Coordinator-free AOI work queue backed by a SQLite database on shared storage.
+
+    Workers lease AOIs, keep their leases alive with a heartbeat thread, and mark them done.
+    Leases that are not renewed expire, so AOIs held by crashed workers are leased again
+    until they reach max_attempts. Chip indices are reserved from a shared counter so that
+    they are unique across all workers.
+    """
+    def __init__(self, path, worker_id=None, lease_seconds=900, heartbeat_seconds=60, max_attempts=3):
+        self.path = Path(path)
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_attempts = max_attempts
+        self._stop_heartbeat = threading.Event()
+        self._heartbeat_thread = None
+
+    @contextmanager
+    def _connect(self):
+        # autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE. Closing the
+        # connection rolls back a transaction left open by an error
+        conn = sqlite3.connect(self.path, timeout=120, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def initialize(self, aoi_indices):
+        """Create the queue tables and add any AOIs that are not yet queued, in priority order."""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS aois (
+                    aoi_index INTEGER PRIMARY KEY,
+                    priority INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    result TEXT,
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    completed_attempt TEXT
+                )
+            """)
+            # queues created before attempts were recorded
+            if "completed_attempt" not in [row[1] for row in conn.execute("PRAGMA table_info(aois)")]:
+                conn.execute("ALTER TABLE aois ADD COLUMN completed_attempt TEXT")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO counters VALUES ('chip_index', 0)")
+            conn.executemany(
+                "INSERT OR IGNORE INTO aois (aoi_index, priority) VALUES (?, ?)",
+                [(int(aoi_index), priority) for priority, aoi_index in enumerate(aoi_indices)],
+            )
+            conn.execute("COMMIT")
+
+    def _expire_leases(self, conn, now):
+        # give up on AOIs whose leases keep expiring
+        conn.execute(
+            "UPDATE aois SET status = 'done', result = 'lease expired', worker = NULL "
+            "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+            (now, self.max_attempts),
+        )
+
+    def expire_leases(self):
+        """Mark AOIs whose leases expired max_attempts times as done, with result 'lease expired'."""
+        with self._connect() as conn:
+            self._expire_leases(conn, time.time())
+
+    def lease(self):
+        """Lease the next pending or expired AOI for this worker. Returns None when the queue is drained."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._expire_leases(conn, now)
+            row = conn.execute(
+                "SELECT aoi_index FROM aois "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY priority LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE aois SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE aoi_index = ?",
+                (self.worker_id, now + self.lease_seconds, row[0]),
+            )
+            conn.execute("COMMIT")
+        return row[0]
+
+    def heartbeat(self):
+        """Extend the leases of all AOIs held by this worker."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE aois SET lease_expires = ? WHERE status = 'leased' AND worker = ?",
+                (time.time() + self.lease_seconds, self.worker_id),
+            )
+
+    def complete(self, aoi_index, result, attempt=None):
+        """Mark a leased AOI as done and record its status and the id of the attempt which completed it."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE aois SET status = 'done', result = ?, completed_attempt = ?, worker = NULL, "
+                "lease_expires = NULL WHERE aoi_index = ? AND worker = ?",
+                (result, attempt, int(aoi_index), self.worker_id),
+            )
+
+    def completed_rows(self, chip_metadata_df):
+        """
+        Keep the chip metadata rows written by the attempt which completed each AOI, dropping rows
+        of attempts which crashed before completing their lease. Rows are matched on their attempt
+        column, which is dropped, rows without an attempt are kept.
+        """
+        if 'attempt' not in chip_metadata_df:
+            return chip_metadata_df
+        with self._connect() as conn:
+            completed = dict(conn.execute(
+                "SELECT aoi_index, completed_attempt FROM aois WHERE status = 'done'"
+            ).fetchall())
+        attempts = chip_metadata_df['attempt']
+        keep = attempts.isna() | (attempts == chip_metadata_df['aoi_index'].map(completed))
+        return chip_metadata_df[keep].drop(columns='attempt')
+
+    def reserve_chip_indices(self, count):
+        """Reserve a contiguous block of globally unique chip indices and return the first one."""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            start = conn.execute("SELECT value FROM counters WHERE name = 'chip_index'").fetchone()[0]
+            conn.execute("UPDATE counters SET value = ? WHERE name = 'chip_index'", (start + count,))
+            conn.execute("COMMIT")
+        return start
+
+    def is_finished(self):
+        """True when no AOI is pending or leased by any worker."""
+        with self._connect() as conn:
+            remaining = conn.execute(
+                "SELECT COUNT(*) FROM aois WHERE status = 'pending' "
+                "OR (status = 'leased' AND (lease_expires >= ? OR attempts < ?))",
+                (time.time(), self.max_attempts),
+            ).fetchone()[0]
+        return remaining == 0
+
+    def pending(self):
+        """Number of AOIs which are not done yet."""
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM aois WHERE status != 'done'").fetchone()[0]
+
+    def results(self):
+        """Returns a dict of aoi_index -> recorded status for all finished AOIs."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT aoi_index, result FROM aois WHERE status = 'done'").fetchall()
+        return dict(rows)
+
+    def claim_finalize(self):
+        """Atomically claim the merge/clean step, so only one worker performs it."""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            claimed = conn.execute("SELECT 1 FROM counters WHERE name = 'finalized'").fetchone()
+            if not claimed:
+                conn.execute("INSERT INTO counters VALUES ('finalized', 1)")
+            conn.execute("COMMIT")
+        return not claimed
+
+    def start_heartbeat(self):
+        """Start a background thread that renews this worker's leases."""
+        def beat():
+            while not self._stop_heartbeat.wait(self.heartbeat_seconds):
+                try:
+                    self.heartbeat()
+                except sqlite3.OperationalError as e:
+                    print(f"heartbeat failed: {e}")
+
+        self._stop_heartbeat.clear()
+        self._heartbeat_thread = threading.Thread(target=beat, daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        self._stop_heartbeat.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
@@ -0,0 +1,176 @@
+from collections import defaultdict
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import rioxarray  # noqa: F401  registers the rio accessor
+from shapely.geometry import box
+import xarray as xr
+
+from src.chip_generator import ChipGenerator
+from src.utils.array import process_array
+from src.utils.chip_store import ChipStore
+from src.utils.footprints import FootprintIndex
+
+RESOLUTION = 10
+SAMPLE_SIZE = 40
+
+
+def make_stack(n_rows, n_cols):
+    """A stack of ones with stackstac coordinates, sample blocks of 4 x 4 pixels"""
+    return xr.DataArray(
+        np.ones((n_rows, n_cols), dtype="uint16"),
+        dims=("y", "x"),
+        coords={
+            "x": 500000.0 + RESOLUTION * np.arange(n_cols),
+            "y": 4000000.0 - RESOLUTION * np.arange(n_rows),
+        },
+    )
+
+
+def make_generator(memory_estimates=None, split=True, sensor_at_a_time=False):
+    config = SimpleNamespace(
+        chips=SimpleNamespace(chip_size=SAMPLE_SIZE, sample_size=SAMPLE_SIZE, sensor_at_a_time=sensor_at_a_time),
+        memory=SimpleNamespace(split=split),
+        s2l2a=SimpleNamespace(resolution=RESOLUTION),
+    )
+    processor = SimpleNamespace(config=config, memory_estimates=memory_estimates or {})
+    return ChipGenerator(processor)
+
+
+def extract(stack, x, y, offset=0):
+    return process_array(
+        stack=stack,
+        epsg=32633,
+        coords=(x, y),
+        array_name="s2l2a",
+        chip_size=SAMPLE_SIZE,
+        sample_size=SAMPLE_SIZE,
+        resolution=RESOLUTION,
+        na_value=0,
+        offset=(0, offset),
+    )
+
+
+def test_extract_last_row_of_stack():
+    array, _ = extract(make_stack(8, 8), x=1, y=1)
+    assert array.shape == (4, 4)
+    assert (array == 1).all()
+
+
+def test_extract_last_row_of_strip():
+    generator = make_generator()
+    stack = make_stack(12, 8)
+    window, offset = generator.tile_window("s2l2a", stack, 1, 2)
+    assert (offset, window.sizes["y"]) == (4, 4)
+    array, _ = extract(window, x=1, y=1, offset=offset)
+    assert (array == 1).all()
+    assert array.y.values.tolist() == stack.y.values[4:8].tolist()
+
+
+def test_plan_tiles_without_budget():
+    generator = make_generator({"lulc": 100, "s2l2a": 600, "s1rtc": 400})
+    assert generator.plan_tiles(10, None) == ([(0, 10)], 1000)
+    assert generator.plan_tiles(10, 1000) == ([(0, 10)], 1000)
+
+
+def test_plan_tiles_splits_into_strips():
+    generator = make_generator({"lulc": 100, "s2l2a": 600, "s1rtc": 400})
+    # 100 bytes per sample row and one row of margin per strip
+    tiles, tile_bytes = generator.plan_tiles(10, 450)
+    assert tiles == [(0, 3), (3, 6), (6, 9), (9, 10)]
+    assert tile_bytes == 400
+
+
+def test_plan_tiles_sensor_at_a_time():
+    generator = make_generator({"lulc": 100, "s2l2a": 600, "s1rtc": 400}, sensor_at_a_time=True)
+    assert generator.plan_tiles(10, 700) == ([(0, 10)], 600)
+
+
+def test_plan_tiles_over_budget():
+    with pytest.raises(ValueError, match="memory budget exceeded"):
+        make_generator({"s2l2a": 1000}, split=False).plan_tiles(10, 500)
+    with pytest.raises(ValueError, match="memory budget exceeded"):
+        make_generator({"s2l2a": 1000}).plan_tiles(10, 150)
+
+
+def test_no_candidates_after_lulc_read_error():
+    generator = make_generator()
+    generator.processor.stacks = {"lulc": make_stack(8, 8) * 0}
+    generator.processor.config.lulc = SimpleNamespace(resolution=RESOLUTION)
+    with pytest.raises(ValueError, match="no candidate windows"):
+        generator.generate_from_lulc([(0, 2)])
+    # failed land cover windows are nodata, so the AOI has no candidates for a transient reason
+    generator.read_errors = {"lulc": [object()]}
+    with pytest.raises(ValueError, match="lulc read error"):
+        generator.generate_from_lulc([(0, 2)])
+
+
+def make_keyed_generator(**lulc_params):
+    generator = make_generator()
+    config = generator.processor.config
+    for name in ["s2l2a", "s1rtc", "lc2l2", "dem"]:
+        setattr(config, name, SimpleNamespace(resolution=RESOLUTION, bands=["B02", "B03"], dtype="uint16", na_value=0))
+    config.lulc = SimpleNamespace(resolution=RESOLUTION, year="2023", sampling_factor=2, sampling_seed=0, **lulc_params)
+    generator.processor.stacks = {"lulc": make_stack(8, 8)}
+    generator.processor.scene_ids = {"s2l2a_scene_ids": "S2A_1,S2B_2", "s1rtc_scene_ids": "S1A_3"}
+    generator.processor.epsg = 32633
+    return generator
+
+
+def test_chip_key_is_stable():
+    key = make_keyed_generator().chip_key(1, 0)
+    assert make_keyed_generator().chip_key(1, 0) == key
+    # sampling settings do not change what a chip contains
+    generator = make_keyed_generator()
+    generator.processor.config.lulc.sampling_seed = 1
+    generator.processor.config.lulc.sampling_factor = 3
+    assert generator.chip_key(1, 0) == key
+
+    assert make_keyed_generator().chip_key(0, 1) != key
+    assert make_keyed_generator(composite="mean").chip_key(1, 0) != key
+    generator = make_keyed_generator()
+    generator.processor.scene_ids["s2l2a_scene_ids"] = "S2A_1"
+    assert generator.chip_key(1, 0) != key
+
+
+def test_chip_store_key_is_stable():
+    # keys of chips stored by earlier runs, which change only with the store format
+    key = ChipStore.key(scene_ids={"s2l2a": ["a", "b"]}, epsg=32633, window=(0, 4))
+    assert key == "408c9123c03d4f7a18186a011610a76b4338ef38"
+    assert ChipStore.key(window=(0, 4), epsg=32633, scene_ids={"s2l2a": ["a", "b"]}) == key
+
+
+def make_attempt(footprint_index):
+    """A generator for one attempt at an AOI, against the run-wide footprint index"""
+    generator = make_generator()
+    generator.processor.footprint_index = footprint_index
+    generator.processor.accepted_footprints = FootprintIndex()
+    generator.processor.working_directory = "."
+    generator.processor.events = None
+    generator.processor.aoi_index = 0
+    return generator
+
+
+def test_retried_aoi_accepts_its_chips_again(tmp_path):
+    footprint_index = FootprintIndex(tmp_path / "chip_footprints.tsv")
+    footprint_index.add(0, box(0.0, 0.0, 0.02, 0.02))
+    footprint = box(1.0, 1.0, 1.02, 1.02).wkt
+
+    # the first attempt accepts a chip, rejects chips duplicating it and fails before committing
+    attempt = make_attempt(footprint_index)
+    attempt.check_accepted(5, footprint, defaultdict(int))
+    attempt.accept(7, 5, footprint, {}, defaultdict(int))
+    with pytest.raises(ValueError, match="duplicate"):
+        attempt.check_accepted(5, footprint, defaultdict(int))
+    with pytest.raises(ValueError, match="duplicate"):
+        attempt.check_accepted(5, box(0.0, 0.0, 0.02, 0.02).wkt, defaultdict(int))
+
+    # the retry finds only chips of committed AOIs in the index, also when it is read again
+    retry = make_attempt(FootprintIndex(tmp_path / "chip_footprints.tsv"))
+    retry.check_accepted(5, footprint, defaultdict(int))
+    retry.accept(8, 5, footprint, {}, defaultdict(int))
+
+    footprint_index.extend(retry.processor.accepted_footprints.footprints)
+    with pytest.raises(ValueError, match="duplicate"):
+        make_attempt(FootprintIndex(tmp_path / "chip_footprints.tsv")).check_accepted(5, footprint, defaultdict(int))
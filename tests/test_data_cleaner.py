@@ -0,0 +1,154 @@
+import json
+import random
+from types import SimpleNamespace
+
+import geopandas as gpd
+import pandas as pd
+from shapely.geometry import Point
+
+from src.data_cleaner import DataCleaner
+from src.utils.tables import read_table, write_table
+
+CLASS_COUNTS = {1: 40, 2: 100, 5: 25, 7: 10, 11: 60}
+
+
+def make_cleaner(tmp_path, sampling_factor=2, sampling_seed=0, incremental=False):
+    config = SimpleNamespace(
+        dataset=SimpleNamespace(version="v0.1"),
+        directory=SimpleNamespace(
+            working=tmp_path / "working", output=tmp_path / "output", table_formats=["geojson"], zip_output=False
+        ),
+        lulc=SimpleNamespace(sampling_factor=sampling_factor, sampling_seed=sampling_seed),
+        publish=SimpleNamespace(incremental=incremental),
+    )
+    for directory in [config.directory.working, config.directory.output]:
+        (directory / "v0.1").mkdir(parents=True)
+    return DataCleaner(config)
+
+
+def make_chips(class_counts):
+    lulc = [lulc_class for lulc_class, count in class_counts.items() for _ in range(count)]
+    return gpd.GeoDataFrame(
+        {"chip_index": range(len(lulc)), "lulc": lulc},
+        geometry=[Point(i, 0) for i in range(len(lulc))],
+        crs=4326,
+    )
+
+
+def baseline_balance(metadata_gdf, sampling_factor):
+    """Class balancing as it was before the seeded ranking"""
+    class_counts = metadata_gdf.groupby("lulc").count()
+    max_count = class_counts.max().iloc[0]
+    min_count = class_counts.min().iloc[0]
+    correction_factor = (max_count - min_count * sampling_factor) / (max_count - min_count)
+    for lulc_class, row in class_counts.iterrows():
+        class_indices = sorted(metadata_gdf[metadata_gdf.lulc == lulc_class].index.values)
+        drop_count = int(correction_factor * (row["chip_index"] - min_count))
+        metadata_gdf = metadata_gdf.drop(random.sample(class_indices, drop_count))
+    return metadata_gdf
+
+
+def test_balance_keeps_baseline_class_counts(tmp_path):
+    chips = make_chips(CLASS_COUNTS)
+    balanced = make_cleaner(tmp_path).balance(chips)
+    expected = baseline_balance(chips, sampling_factor=2)
+    assert balanced["lulc"].value_counts().to_dict() == expected["lulc"].value_counts().to_dict()
+    assert balanced["lulc"].value_counts().max() <= 2 * min(CLASS_COUNTS.values())
+
+
+def test_balance_is_deterministic(tmp_path):
+    chips = make_chips(CLASS_COUNTS)
+    cleaner = make_cleaner(tmp_path, sampling_seed=7)
+    selected = set(cleaner.balance(chips)["chip_index"])
+    assert set(cleaner.balance(chips)["chip_index"]) == selected
+    # the selection does not depend on the order the chips were gathered in
+    shuffled = chips.sample(frac=1, random_state=3)
+    assert set(cleaner.balance(shuffled)["chip_index"]) == selected
+
+    cleaner.config.lulc.sampling_seed = 8
+    assert set(cleaner.balance(chips)["chip_index"]) != selected
+
+
+def test_balance_counts_published_chips(tmp_path):
+    cleaner = make_cleaner(tmp_path)
+    chips = make_chips({1: 10, 2: 50})
+    # 10 trees chips were published before, so 40 of the new ones are dropped
+    balanced = cleaner.balance(chips, published_counts=pd.Series({2: 10}))
+    assert balanced["lulc"].value_counts().to_dict() == {1: 10, 2: 10}
+    # published chips are never dropped, even when they exceed the sampling factor
+    balanced = cleaner.balance(make_chips({1: 10, 2: 5}), published_counts=pd.Series({2: 45}))
+    assert balanced["lulc"].value_counts().to_dict() == {1: 10}
+
+
+def make_release_chip(cleaner, id=5, original_id=12):
+    """One chip with a date per modality and its working files, numbered as release chip id"""
+    row = pd.Series({"id": id, "original_id": original_id, "s2l2a_dates": "20230101", "s1rtc_dates": "20230102", "lc2l2_dates": "20230103"})
+    for src_file, _ in cleaner.release_files(row):
+        src_file.write_bytes(b"chip")
+    return pd.DataFrame([row])
+
+
+def test_load_manifest(tmp_path):
+    cleaner = make_cleaner(tmp_path, incremental=True)
+    assert cleaner.load_manifest() == {"next_id": 0, "files": {}}
+
+    cleaner.manifest_path.write_text('{"next_id": 6, "files": {"dem_000005.tif": [4, 1]}}')
+    # a manifest without the tracker it describes is not a release to append to
+    assert cleaner.load_manifest()["next_id"] == 0
+    cleaner.tracker_path.write_text("{}")
+    assert cleaner.load_manifest() == {"next_id": 6, "files": {"dem_000005.tif": [4, 1]}}
+
+    cleaner.config.publish.incremental = False
+    assert cleaner.load_manifest()["next_id"] == 0
+
+
+def test_copy_files_skips_unchanged_files(tmp_path):
+    cleaner = make_cleaner(tmp_path, incremental=True)
+    chips = make_release_chip(cleaner)
+    copied_files = cleaner.copy_files(chips, {})
+    assert sorted(copied_files) == sorted(dst_file.name for _, dst_file in cleaner.release_files(chips.iloc[0]))
+    assert (cleaner.output_dir / "v0.1" / "dem_000005.tif").read_bytes() == b"chip"
+
+    # only the source changed since the last copy is copied again
+    (cleaner.working_dir / "v0.1" / "dem_000012.tif").write_bytes(b"new chip")
+    cleaner.copy_files(chips, copied_files)
+    # a destination removed from the release is copied again
+    (cleaner.output_dir / "v0.1" / "s2l2a_000005_20230101.png").unlink()
+    cleaner.copy_files(chips, copied_files)
+
+    events = [json.loads(line) for line in cleaner.events.path.read_text().splitlines()]
+    assert [event["files"] for event in events] == [7, 1, 1]
+    assert (cleaner.output_dir / "v0.1" / "dem_000005.tif").read_bytes() == b"new chip"
+
+
+def write_release(cleaner, original_ids, start_id):
+    """Select working chips for the release as clean does, numbered from start_id"""
+    rows = []
+    for i, original_id in enumerate(original_ids):
+        row = make_release_chip(cleaner, id=start_id + i, original_id=original_id).iloc[0]
+        rows.append({**row, "chip_footprint": Point(original_id, 0)})
+    chips = gpd.GeoDataFrame(rows, geometry="chip_footprint", crs=4326)
+    write_table(chips, cleaner.working_dir / "v0.1", "release_chips", ["geojson"])
+
+
+def test_publish_twice(tmp_path):
+    cleaner = make_cleaner(tmp_path, incremental=True)
+    write_release(cleaner, [12, 13], start_id=0)
+    assert cleaner.unpublished_chips() == 2
+    cleaner.publish()
+    assert cleaner.unpublished_chips() == 0
+    # publishing again, or after a publish interrupted once the tracker was written, adds nothing
+    cleaner.publish()
+    cleaner.manifest_path.write_text('{"next_id": 1, "files": {}}')
+    cleaner.publish()
+    tracker = read_table(cleaner.output_dir / "v0.1", "gelos_chip_tracker", ["geojson"])
+    assert sorted(tracker["id"]) == [0, 1]
+    assert json.loads(cleaner.manifest_path.read_text())["next_id"] == 2
+
+    # the next release is appended once
+    write_release(cleaner, [14], start_id=2)
+    cleaner.publish()
+    cleaner.publish()
+    tracker = read_table(cleaner.output_dir / "v0.1", "gelos_chip_tracker", ["geojson"])
+    assert sorted(zip(tracker["id"], tracker["original_id"])) == [(0, 12), (1, 13), (2, 14)]
+    assert json.loads(cleaner.manifest_path.read_text())["next_id"] == 3
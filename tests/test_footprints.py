@@ -0,0 +1,35 @@
+from shapely.geometry import box
+
+from src.utils.footprints import FootprintIndex
+
+
+def test_duplicate_footprints(tmp_path):
+    index = FootprintIndex(tmp_path / "footprints.tsv", overlap_threshold=0.5, cell_size=0.05)
+    index.add(0, box(0.0, 0.0, 0.02, 0.02))
+    # overlapping by three quarters, by a quarter, and touching only at an edge
+    assert index.is_duplicate(box(0.005, 0.0, 0.025, 0.02))
+    assert not index.is_duplicate(box(0.015, 0.0, 0.035, 0.02))
+    assert not index.is_duplicate(box(0.02, 0.0, 0.04, 0.02).wkt)
+    # a footprint spanning a cell boundary is found from a footprint in one of its cells
+    index.add(1, box(0.04, 0.04, 0.06, 0.06))
+    assert index.is_duplicate(box(0.05, 0.05, 0.06, 0.06))
+    assert len(index) == 2
+
+
+def test_footprints_are_shared_through_the_index_file(tmp_path):
+    path = tmp_path / "footprints.tsv"
+    worker, other = FootprintIndex(path), FootprintIndex(path)
+    worker.add(3, box(1.0, 1.0, 1.02, 1.02).wkt)
+    assert not other.is_duplicate(box(1.0, 1.0, 1.02, 1.02))
+    # a partial line another worker is still writing is read on a later refresh
+    with open(path, "a") as f:
+        f.write("4\tPOLYGON ((2 2, 2.02 2, 2.02 2.02")
+    other.refresh()
+    assert other.is_duplicate(box(1.0, 1.0, 1.02, 1.02))
+    assert len(other) == 1
+    with open(path, "a") as f:
+        f.write(", 2 2.02, 2 2))\n")
+    other.refresh()
+    assert other.is_duplicate(box(2.0, 2.0, 2.02, 2.02))
+    # a resumed run loads every footprint
+    assert len(FootprintIndex(path)) == 2
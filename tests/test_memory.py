@@ -0,0 +1,34 @@
+import threading
+
+import pytest
+
+from src.utils.memory import MemoryBudget
+
+
+def test_reservation_waits_until_memory_is_released():
+    budget = MemoryBudget(100)
+    admitted = threading.Event()
+
+    def reserve_second():
+        with budget.reserve(60):
+            admitted.set()
+
+    with budget.reserve(60):
+        second = threading.Thread(target=reserve_second)
+        second.start()
+        # the second AOI waits while both reservations would exceed the budget
+        assert not admitted.wait(0.2)
+        assert budget.in_flight == 60
+    second.join(timeout=5)
+    assert admitted.is_set()
+    assert budget.in_flight == 0
+
+
+def test_reservations_within_budget_do_not_wait():
+    budget = MemoryBudget(100)
+    with budget.reserve(60), budget.reserve(40):
+        assert budget.in_flight == 100
+    # a reservation which could never fit is refused instead of waiting forever
+    with pytest.raises(ValueError):
+        with budget.reserve(101):
+            pass
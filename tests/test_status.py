@@ -0,0 +1,68 @@
+import json
+
+from src.status import RunStatus
+
+
+def write_events(path, events):
+    with open(path, "a") as f:
+        for event in events:
+            f.write(json.dumps({"worker": "a", **event}) + "\n")
+
+
+def finishes(aoi_indices, start_time):
+    return [
+        {"event": "aoi_finish", "time": start_time + 3600 * (i + 1), "aoi_index": aoi_index, "status": "success"}
+        for i, aoi_index in enumerate(aoi_indices)
+    ]
+
+
+def test_report_after_resume(tmp_path):
+    path = tmp_path / "events.jsonl"
+    # the first run finishes 10 of the 30 pending AOIs of a 50 AOI table
+    write_events(path, [{"event": "run_start", "time": 0, "aois": 30, "total_aois": 50}] + finishes(range(10), 0))
+    status = RunStatus(path)
+    status.refresh()
+    assert "AOIs: 30/50 processed" in status.report()
+
+    # the resumed run sees 20 pending AOIs and finishes 5 of them, one per hour
+    write_events(path, [{"event": "run_start", "time": 100_000, "aois": 20, "total_aois": 50}] + finishes(range(10, 15), 100_000))
+    status.refresh()
+    report = status.report()
+    assert "AOIs: 35/50 processed (15 success, 0 failed)" in report
+    assert "ETA: 15.0 hours" in report
+
+
+def test_report_with_two_workers(tmp_path):
+    path = tmp_path / "events.jsonl"
+    write_events(path, [{"event": "run_start", "time": 0, "aois": 30, "total_aois": 50}] + finishes(range(4), 0))
+    status = RunStatus(path)
+    status.refresh()
+    assert "AOIs: 24/50 processed" in status.report()
+
+    # a second worker joins, finding the AOIs finished by the first done and one leased by it
+    write_events(path, [{"event": "run_start", "worker": "b", "time": 4.5 * 3600, "aois": 26, "total_aois": 50}])
+    status.refresh()
+    assert "AOIs: 24/50 processed" in status.report()
+    write_events(path, [
+        {"event": "aoi_finish", "worker": worker, "time": time * 3600, "aoi_index": aoi_index, "status": "success"}
+        for worker, time, aoi_index in [("a", 5, 4), ("b", 5.5, 5), ("a", 6, 6), ("b", 6.5, 7)]
+    ])
+    status.refresh()
+    report = status.report()
+    assert "AOIs: 28/50 processed (8 success, 0 failed)" in report
+    # 8 AOIs in 6.5 hours since the first worker started
+    assert "ETA: 17.9 hours" in report
+
+
+def test_throughput_excludes_time_between_runs(tmp_path):
+    path = tmp_path / "events.jsonl"
+    chips = [{"event": "chip_written", "time": 1800 * (i + 1), "lulc": 2, "bytes": 0} for i in range(4)]
+    write_events(path, [{"event": "run_start", "time": 0, "aois": 10, "total_aois": 10}] + chips + [{"event": "run_finish", "time": 7200}])
+    # resumed a day later, writing two chips in the first hour
+    later = 86400
+    write_events(path, [{"event": "run_start", "time": later, "aois": 10, "total_aois": 10}] + [
+        {"event": "chip_written", "time": later + 1800 * (i + 1), "lulc": 2, "bytes": 0} for i in range(2)
+    ])
+    status = RunStatus(path)
+    status.refresh()
+    assert "chips: 6 written, 0.00 GB, 2.0 chips/hour" in status.report()
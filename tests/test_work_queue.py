@@ -0,0 +1,121 @@
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from src.work_queue import AOIWorkQueue
+
+
+def make_queue(path, worker_id, lease_seconds=900, max_attempts=3):
+    return AOIWorkQueue(path, worker_id=worker_id, lease_seconds=lease_seconds, max_attempts=max_attempts)
+
+
+def expire(path, aoi_index):
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE aois SET lease_expires = 0 WHERE aoi_index = ?", (aoi_index,))
+
+
+def test_lease_in_priority_order(tmp_path):
+    path = tmp_path / "queue.sqlite"
+    queue = make_queue(path, "a")
+    queue.initialize([5, 3, 9])
+    # initializing again, as every worker does, keeps the queue
+    queue.initialize([5, 3, 9])
+    assert [queue.lease(), queue.lease(), queue.lease(), queue.lease()] == [5, 3, 9, None]
+    assert not queue.is_finished()
+
+    for aoi_index in [5, 3, 9]:
+        queue.complete(aoi_index, "success")
+    assert queue.is_finished()
+    assert queue.pending() == 0
+    assert queue.results() == {5: "success", 3: "success", 9: "success"}
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    path = tmp_path / "queue.sqlite"
+    crashed, worker = make_queue(path, "crashed"), make_queue(path, "worker")
+    crashed.initialize([0, 1])
+    assert crashed.lease() == 0
+    assert worker.lease() == 1
+    # a live lease is not reclaimed
+    assert worker.lease() is None
+
+    expire(path, 0)
+    assert worker.lease() == 0
+    # the crashed worker no longer holds the AOI, its late result is ignored
+    crashed.complete(0, "stale")
+    worker.complete(0, "success")
+    worker.complete(1, "success")
+    assert worker.results() == {0: "success", 1: "success"}
+
+
+def test_heartbeat_renews_leases(tmp_path):
+    path = tmp_path / "queue.sqlite"
+    holder, other = make_queue(path, "holder"), make_queue(path, "other")
+    holder.initialize([0])
+    assert holder.lease() == 0
+    expire(path, 0)
+    holder.heartbeat()
+    assert other.lease() is None
+
+
+def test_lease_expired_at_max_attempts(tmp_path):
+    path = tmp_path / "queue.sqlite"
+    queue = make_queue(path, "a", max_attempts=2)
+    queue.initialize([0])
+    for _ in range(2):
+        assert queue.lease() == 0
+        expire(path, 0)
+    # the AOI is given up on, the queue is drained
+    assert queue.is_finished()
+    assert queue.results() == {}
+    queue.expire_leases()
+    assert queue.results() == {0: "lease expired"}
+    assert queue.lease() is None
+
+
+def test_chip_indices_are_unique(tmp_path):
+    path = tmp_path / "queue.sqlite"
+    a, b = make_queue(path, "a"), make_queue(path, "b")
+    a.initialize([])
+    assert a.reserve_chip_indices(10) == 0
+    assert b.reserve_chip_indices(5) == 10
+    assert a.reserve_chip_indices(1) == 15
+
+
+def test_finalize_is_claimed_once(tmp_path):
+    path = tmp_path / "queue.sqlite"
+    a, b = make_queue(path, "a"), make_queue(path, "b")
+    a.initialize([])
+    assert a.claim_finalize()
+    assert not b.claim_finalize()
+
+
+def test_connections_are_closed(tmp_path):
+    queue = make_queue(tmp_path / "queue.sqlite", "a")
+    queue.initialize([0])
+    with queue._connect() as conn:
+        conn.execute("SELECT 1")
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute("SELECT 1")
+
+
+def test_only_rows_of_completed_attempts_are_merged(tmp_path):
+    path = tmp_path / "queue.sqlite"
+    crashed, worker = make_queue(path, "crashed"), make_queue(path, "worker")
+    crashed.initialize([0, 1, 2])
+    assert crashed.lease() == 0
+    expire(path, 0)
+    assert worker.lease() == 0
+    worker.complete(0, "success", attempt="second")
+    assert worker.lease() == 1
+    worker.complete(1, "success", attempt="first")
+
+    parts = pd.DataFrame({
+        "chip_index": [0, 1, 2, 3, 4, 5],
+        "aoi_index": [0, 0, 0, 0, 1, 2],
+        "attempt": ["first", "first", "second", "second", "first", None],
+    })
+    merged = worker.completed_rows(parts)
+    assert merged["chip_index"].tolist() == [2, 3, 4, 5]
+    assert "attempt" not in merged